@@ -3,20 +3,23 @@ import pandas as pd
 import os
 from sklearn.preprocessing import LabelEncoder
 from sklearn.model_selection import StratifiedShuffleSplit  
-from PIL import Image
+from utils.patch_store import PatchStore
+from utils.patch_dataset import PatchDatasetMixin
 
 
 
-class Dataset:
+class Dataset(PatchDatasetMixin):
     
     def __init__(self, config):
             self.config= config
             self._train_val_dir = "/labs/gevaertlab/data/MICCAI/patches_448"
             self._test_dir = "/labs/gevaertlab/data/MICCAI/patches_448_test"
+            self._train_val_store = PatchStore("/labs/gevaertlab/data/MICCAI/packed_224", config.input_shape)
+            self._test_store = PatchStore("/labs/gevaertlab/data/MICCAI/packed_224_test", config.input_shape)
             self.le = LabelEncoder()
+            self._manifests = {}
             self._partition = self.get_partition()
 
-
     def get_binarized_data(self):
 
         df = pd.read_table('MICCAI_labels.txt', index_col = 0, delim_whitespace = True, header = 0)
@@ -47,23 +50,27 @@ class Dataset:
 
     def convert_to_arrays(self, samples, labels,  phase = ['train','val','test'], size = 1):
         
+        if self.config.patch_format == 'packed':
+            store = self._test_store if phase == 'test' else self._train_val_store
+            if self.config.use_manifest:
+                return self.convert_to_arrays_manifest(store.root, samples, labels, size, store=store)
+            return self.convert_to_arrays_packed(store, samples, labels, size)
+
         if phase == 'test':
             directory = self._test_dir
 
         else: 
              directory = self._train_val_dir
+
+        if self.config.use_manifest:
+            return self.convert_to_arrays_manifest(directory, samples, labels, size)
                  
-        X, ids = [], []
+        ids = []
         for sample in samples:
             patches = os.listdir(directory + "/%s" %sample)
             patches = np.random.choice(patches, size= size, replace=True)
             for patch in patches:
-                ID = directory + "/%s/%s"% (sample, patch)
-                ids.append(ID)
-                img = Image.open(ID)
-                img = img.resize((224, 224))
-                image = np.array(img)[:,:,:3]
-                X.append(image)  
-        X = np.asarray(X)
+                ids.append(directory + "/%s/%s"% (sample, patch))
+        X = self.load_jpeg(ids)
         y = np.repeat(labels, size)
-        return X, y
\ No newline at end of file
+        return X, y
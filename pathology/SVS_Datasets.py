@@ -0,0 +1,124 @@
+import numpy as np
+import os
+from collections import OrderedDict
+from multiprocessing import Pool
+from openslide import OpenSlide
+from Datasets import Dataset
+from preprocessing import get_tissue_mask
+
+
+_handles = OrderedDict()
+_handles_pid = None
+
+def get_slide(path, max_open):
+    """
+    OpenSlide handles kept open per worker process and reused across batches (LRU, at most max_open);
+    handles inherited through a fork are never reused
+    """
+    global _handles_pid
+    if _handles_pid != os.getpid():
+        _handles.clear()
+        _handles_pid = os.getpid()
+    if path in _handles:
+        _handles.move_to_end(path)
+        return _handles[path]
+    while len(_handles) >= max_open:
+        _, slide = _handles.popitem(last=False)
+        slide.close()
+    _handles[path] = OpenSlide(path)
+    return _handles[path]
+
+
+def build_coordinates(slide_path, index_path, config):
+    img = OpenSlide(slide_path)
+    mask = get_tissue_mask(img, config)
+    img.close()
+    rows, cols = np.nonzero(mask)
+    coords = np.stack([cols, rows], axis=1).astype(np.int64) * config.patch_size
+    np.save(index_path, coords)
+    return len(coords)
+
+def build_coordinates_star(args):
+    return build_coordinates(*args)
+
+def build_coordinate_index(slide_dir, index_dir, config, processes=30):
+    """
+    Level 0 (x, y) of every tissue cell of every slide, one <patient>.npy per slide,
+    from the thumbnail tissue mask only: no tile is read
+    """
+    if not os.path.isdir(index_dir):
+        os.makedirs(index_dir)
+    jobs = [("%s/%s"% (slide_dir, name), "%s/%s.npy"% (index_dir, name[:-4]), config)
+            for name in os.listdir(slide_dir) if name.endswith(".svs")]
+    p = Pool(processes)
+    for (slide_path, _, _), count in zip(jobs, p.imap(build_coordinates_star, jobs)):
+        print ("%s: %d tissue tiles"% (slide_path, count))
+    p.close()
+    p.join()
+
+
+class SVS_Dataset(Dataset):
+    """
+    Same partition as Dataset, but patches are read straight from the .svs files at
+    coordinates sampled from the tissue index instead of from a dump of JPEG tiles
+    """
+
+    def __init__(self, config):
+        Dataset.__init__(self, config)
+        self._train_val_slides = config.data_path
+        self._test_slides = config.data_path + "_test"
+        self._train_val_index = "/labs/gevaertlab/data/MICCAI/coords_%d"% config.patch_size
+        self._test_index = "/labs/gevaertlab/data/MICCAI/coords_%d_test"% config.patch_size
+        self._coords = {}
+
+    def get_coords(self, index_dir, sample):
+        if self.config.use_manifest:
+            manifest = self.get_manifest(index_dir)
+            row = manifest.rows([sample])[0]
+            return manifest.coords[manifest.offsets[row]:manifest.offsets[row + 1]]
+        key = (index_dir, sample)
+        if key not in self._coords:
+            self._coords[key] = np.load("%s/%s.npy"% (index_dir, sample))
+        return self._coords[key]
+
+    def get_manifest_root(self, phase):
+        return (self._test_index if phase == 'test' else self._train_val_index), None
+
+    def load_manifest_patches(self, root, samples, indexes, store = None):
+
+        manifest = self.get_manifest(root)
+        slide_dir = self._test_slides if root == self._test_index else self._train_val_slides
+        patch_size, shape = self.config.patch_size, self.config.input_shape
+        X = np.empty((indexes.size, shape, shape, 3), dtype=np.uint8)
+        for i, sample in enumerate(samples):
+            slide = get_slide("%s/%s.svs"% (slide_dir, sample), self.config.max_open_slides)
+            for k, c in enumerate(indexes[i]):
+                patch = slide.read_region(location=tuple(manifest.coords[c]), level=0, size=(patch_size, patch_size))
+                X[i*indexes.shape[1] + k] = np.array(patch.convert('RGB').resize((shape, shape)))
+        return X
+
+    def convert_to_arrays(self, samples, labels, phase = ['train','val','test'], size = 1):
+
+        if phase == 'test':
+            slide_dir, index_dir = self._test_slides, self._test_index
+        else:
+            slide_dir, index_dir = self._train_val_slides, self._train_val_index
+
+        patch_size, shape = self.config.patch_size, self.config.input_shape
+        X = np.empty((len(samples)*size, shape, shape, 3), dtype=np.uint8)
+        for i, sample in enumerate(samples):
+            slide = get_slide("%s/%s.svs"% (slide_dir, sample), self.config.max_open_slides)
+            coords = self.get_coords(index_dir, sample)
+            # sorted so that reads walk the slide in file order
+            for k, c in enumerate(np.sort(np.random.randint(len(coords), size=size))):
+                patch = slide.read_region(location=tuple(coords[c]), level=0, size=(patch_size, patch_size))
+                X[i*size + k] = np.array(patch.convert('RGB').resize((shape, shape)))
+        y = np.repeat(labels, size)
+        return X, y
+
+
+if __name__ == '__main__':
+    from config import Config
+    config = Config()
+    build_coordinate_index(config.data_path, "/labs/gevaertlab/data/MICCAI/coords_%d"% config.patch_size, config)
+    build_coordinate_index(config.data_path + "_test", "/labs/gevaertlab/data/MICCAI/coords_%d_test"% config.patch_size, config)
@@ -3,10 +3,11 @@ import pandas as pd
 import os
 from sklearn.preprocessing import LabelEncoder
 from sklearn.model_selection import StratifiedShuffleSplit  
-from PIL import Image
+from utils.patch_store import PatchStore
+from utils.patch_dataset import PatchDatasetMixin
 
 
-class TCGA_Dataset:
+class TCGA_Dataset(PatchDatasetMixin):
     
     def __init__(self, config):
 
@@ -14,21 +15,39 @@ class TCGA_Dataset:
         self._train_val_dir = '/labs/gevaertlab/data/cedoz/patches_448'
         self._test_dir = '/labs/gevaertlab/data/MICCAI/patches_448_test'
        # self._test_dir = '/labs/gevaertlab/data/MICCAI/patches_448'
+        self._train_val_store = PatchStore('/labs/gevaertlab/data/cedoz/packed_224', config.input_shape)
+        self._test_store = PatchStore('/labs/gevaertlab/data/MICCAI/packed_224_test', config.input_shape)
         self.le = LabelEncoder()
+        self._manifests = {}
         self._samples = self.get_samples()
         self._labels  = self.get_labels()
         self._partition = self.get_partition()
 
+
+    def get_train_val_root(self):
+        if self.config.patch_format == 'packed':
+            return self._train_val_store.root
+        return self._train_val_dir
      
     def get_samples(self):
         
-        samples_0 = os.listdir(self._train_val_dir)
+        if self.config.use_manifest:
+            return self.get_manifest(self.get_train_val_root()).patients
+        if self.config.patch_format == 'packed':
+            samples_0 = os.listdir(self._train_val_store.root)
+        else:
+            samples_0 = os.listdir(self._train_val_dir)
         samples_1= list(pd.read_excel('TCGA-MICCAI-Patients.xlsx', index_col = 'Patient').index)
         samples = np.intersect1d(samples_0, samples_1)
         return samples
 
     
     def get_labels(self):
+        if self.config.use_manifest:
+            manifest = self.get_manifest(self.get_train_val_root())
+            self.le.fit(manifest.classes)
+            print(dict(zip(manifest.classes, range(len(manifest.classes)))))
+            return manifest.labels
         df = pd.read_excel('TCGA-MICCAI-Patients.xlsx',index_col = 'Patient')
         df = df[df.index.isin(self._samples)]
         labels = df.apply(self.le.fit_transform).values.flatten()
@@ -38,9 +57,12 @@ class TCGA_Dataset:
   
     def get_partition(self):
         
-        df = pd.read_excel('TCGA-MICCAI-Patients.xlsx',index_col = 'Patient')
-        df = df[df.index.isin(self._samples)]
-        ids = df.index
+        if self.config.use_manifest:
+            ids = pd.Index(self._samples)
+        else:
+            df = pd.read_excel('TCGA-MICCAI-Patients.xlsx',index_col = 'Patient')
+            df = df[df.index.isin(self._samples)]
+            ids = df.index
         labels = self._labels
  
         sss = StratifiedShuffleSplit(n_splits=1, test_size= self.config.val_size)
@@ -64,23 +86,27 @@ class TCGA_Dataset:
 
     def convert_to_arrays(self, samples, labels, phase = ['train','val','test'], size = 1):
         
+        if self.config.patch_format == 'packed':
+            store = self._test_store if phase == 'test' else self._train_val_store
+            if self.config.use_manifest:
+                return self.convert_to_arrays_manifest(store.root, samples, labels, size, store=store)
+            return self.convert_to_arrays_packed(store, samples, labels, size)
+
         if phase == 'test':
             directory = self._test_dir
         else: 
             directory = self._train_val_dir
+
+        if self.config.use_manifest:
+            return self.convert_to_arrays_manifest(directory, samples, labels, size)
                 
-        X, ids = [], []
+        ids = []
         for sample in samples:
             patches = os.listdir(directory + '/%s' % sample)
             patches = np.random.choice(patches, size= size, replace=True)
             for patch in patches:
-                ID = directory + "/%s/%s"% (sample, patch)
-                ids.append(ID)               
-                img = Image.open(ID)
-                img = img.resize((224,224))
-                image = np.array(img)[:,:,:3]
-                X.append(image)  
-        X = np.asarray(X)        
+                ids.append(directory + "/%s/%s"% (sample, patch))
+        X = self.load_jpeg(ids)
         y = np.repeat(labels, size)
         
-        return X, y
\ No newline at end of file
+        return X, y
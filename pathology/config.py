@@ -1,7 +1,19 @@
 class Config(object):
 
     def __init__(self, data_path="/labs/gevaertlab/data/MICCAI/pathology", patch_size=448, threshold=0.4,
-                 selected_features=['out'], input_shape = 224, val_size = 0.30, test_size = 0.00, epochs = 5, gpu = "0", sampling_size_train  = 500, sample_size_feat = 500, sampling_size_val = 500, sampling_size_test = 500, batch_size = 5, lr = 5e-6, lr_decay=1e-6, from_idx=0):
+                 selected_features=['out'], input_shape = 224, val_size = 0.30, test_size = 0.00, epochs = 5, gpu = "0", sampling_size_train  = 500, sample_size_feat = 500, sampling_size_val = 500, sampling_size_test = 500, batch_size = 5, lr = 5e-6, lr_decay=1e-6, from_idx=0,
+                 tissue_mask = True, mask_cell_size = 8, mask_threshold = 0.10, patch_check = True,
+                 patch_format = 'jpeg', strip_reads = True, strip_tiles = 32, write_workers = 4, write_queue = 64,
+                 lock_timeout = 3600, scales = [1],
+                 dataset = 'miccai', max_open_slides = 16, use_manifest = False,
+                 fast_decode = True, decode_workers = 8, seed = 0,
+                 shared_memory = True, feat_batch_size = 100,
+                 mc_samples = 10, mc_head = True, train_head_only = False, embedding_dir = "/labs/gevaertlab/data/MICCAI/embeddings",
+                 aggregation = 'mean', aggregation_trim = 0.1, aggregation_k = 10, aggregation_q = 0.5,
+                 adaptive_sampling = False, adaptive_round = 25, adaptive_min = 50, adaptive_tol = 0.02, adaptive_z = 1.96,
+                 step_trace = None, autoscale_loader = True, min_workers = 2, max_workers = None, min_queue = 4, max_queue = 64,
+                 loader_memory_gb = None, async_validation = False, validation_device = '', lazy_splits = False, split_cache_dir = None,
+                 parallel_workers = 1, parallel_threads = None, parallel_loader_workers = 2):
         
         self.data_path = data_path
         self.patch_size = patch_size
@@ -23,4 +35,83 @@ class Config(object):
         self.lr = lr
         self.lr_decay = lr_decay
         self.from_idx = from_idx
+
+        # preprocessing: thumbnail tissue mask, then the per-patch Otsu check as a second stage
+        self.tissue_mask = tissue_mask
+        self.mask_cell_size = mask_cell_size
+        self.mask_threshold = mask_threshold
+        self.patch_check = patch_check
+        # 'jpeg': one file per 448px tile, 'packed': one memory-mappable PatchStore per slide with input_shape tiles
+        self.patch_format = patch_format
+        # read up to strip_tiles tiles of a row per read_region; encoding runs on write_workers threads
+        self.strip_reads = strip_reads
+        self.strip_tiles = strip_tiles
+        self.write_workers = write_workers
+        self.write_queue = write_queue
+        # seconds without a row completing after which another node may take over a slide
+        self.lock_timeout = lock_timeout
+        # field of view of each emitted patch in units of patch_size at level 0 (1 = the patch_size grid itself);
+        # scale s is written to <patches dir>_x<s>/<patient> with the same tile indexes as scale 1
+        self.scales = scales
+
+        # 'miccai': Dataset, 'tcga': TCGA_Dataset, 'svs': SVS_Dataset streaming tiles from the slides
+        self.dataset = dataset
+        self.max_open_slides = max_open_slides
+        # sample patches from the <patch root>.manifest.npz index built by utils/manifest.py instead of listing directories
+        self.use_manifest = use_manifest
+        # decode JPEG patches at reduced size (draft mode) on decode_workers threads, straight into the batch buffer
+        self.fast_decode = fast_decode
+        self.decode_workers = decode_workers
+        # training batches only depend on (seed, epoch, batch index)
+        self.seed = seed
+        # loader workers hand batches to the trainer through shared-memory slots instead of pickling them
+        self.shared_memory = shared_memory
+        # patches of a patient loaded and scored at a time when extracting features
+        self.feat_batch_size = feat_batch_size
+        # Monte-Carlo dropout passes; mc_head runs the backbone once and samples only the dense head
+        self.mc_samples = mc_samples
+        self.mc_head = mc_head
+        # freeze DenseNet169 and train the dense head from float16 embeddings cached under embedding_dir (needs use_manifest)
+        self.train_head_only = train_head_only
+        self.embedding_dir = embedding_dir
+        # patch to patient aggregation of the predicted scores: 'mean', 'trimmed_mean' (trim per side), 'topk_mean' (k) or 'quantile' (q)
+        self.aggregation = aggregation
+        self.aggregation_trim = aggregation_trim
+        self.aggregation_k = aggregation_k
+        self.aggregation_q = aggregation_q
+        # score patches in rounds of adaptive_round and stop a patient once the adaptive_z confidence interval
+        # of its mean score is within +/- adaptive_tol (at least adaptive_min, at most sample_size_feat patches)
+        self.adaptive_sampling = adaptive_sampling
+        self.adaptive_round = adaptive_round
+        self.adaptive_min = adaptive_min
+        self.adaptive_tol = adaptive_tol
+        self.adaptive_z = adaptive_z
         
+        # JSONL file receiving the per-step data-wait/compute timings and per-epoch summaries of training (None: no trace)
+        self.step_trace = step_trace
+        # resize the shared-memory loader at runtime from data-wait time and queue occupancy, between min_workers and
+        # max_workers (None: all cores) loader processes and min_queue and max_queue batches, loader memory below loader_memory_gb
+        self.autoscale_loader = autoscale_loader
+        self.min_workers = min_workers
+        self.max_workers = max_workers
+        self.min_queue = min_queue
+        self.max_queue = max_queue
+        self.loader_memory_gb = loader_memory_gb
+        # validate each epoch in a separate process while the next one trains (val_ metrics arrive one epoch late,
+        # so training runs all its epochs without early stopping)
+        self.async_validation = async_validation
+        # GPUs visible to the validation process ('' for CPU): on CPU it leaves the trainer GPU alone, but validating
+        # DenseNet169 there can take longer than an epoch, and the trainer then waits for it at the end of the next one;
+        # a GPU id (e.g. config.gpu, shared with the trainer) keeps validation faster than training
+        self.validation_device = validation_device
+        # stream the val/test patients instead of decoding them all at init (less memory, but validation re-decodes
+        # them every epoch unless split_cache_dir is set: their (fixed-seed) patches are then saved on first use and
+        # memory-mapped across epochs and runs; required with async_validation)
+        self.lazy_splits = lazy_splits
+        self.split_cache_dir = split_cache_dir
+        # data-parallel CPU training: parallel_workers model replicas (1: off) on parallel_threads cores each (None: an equal share),
+        # averaging gradients every step, i.e. batches parallel_workers times larger; each replica loads on parallel_loader_workers processes
+        # (the splits are then always streamed, as with lazy_splits: each replica decodes only its share of the validation patients)
+        self.parallel_workers = parallel_workers
+        self.parallel_threads = parallel_threads
+        self.parallel_loader_workers = parallel_loader_workers
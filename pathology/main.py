@@ -12,20 +12,22 @@ import matplotlib
 matplotlib.use('Agg')
 
 
-if os.path.isdir("output/"):
-    shutil.rmtree("output/")
-os.makedirs("output/")
+# guarded: the validation worker (config.async_validation) is a spawned process that re-imports this module
+if __name__ == '__main__':
+    if os.path.isdir("output/"):
+        shutil.rmtree("output/")
+    os.makedirs("output/")
 
-config = Config(epochs = 30, gpu = "1", sampling_size_train = 40, sampling_size_val = 40, batch_size = 1 ,lr = 1e-4, val_size = 0.25)
+    config = Config(epochs = 30, gpu = "1", sampling_size_train = 40, sampling_size_val = 40, batch_size = 1 ,lr = 1e-4, val_size = 0.25)
 
-session_config = tf.ConfigProto()
-session_config.gpu_options.visible_device_list = config.gpu
-session_config.gpu_options.allow_growth = True
-set_session(tf.Session(config=session_config))
+    session_config = tf.ConfigProto()
+    session_config.gpu_options.visible_device_list = config.gpu
+    session_config.gpu_options.allow_growth = True
+    set_session(tf.Session(config=session_config))
 
-model = Model(config)
-model.train_predict()
-#y_scores, y_preds = model.train_predict()
-#model.get_metrics(y_scores, y_preds)
-#model.plot_ROCs(y_scores)
-#model.plot_PRs(y_scores)
\ No newline at end of file
+    model = Model(config)
+    model.train_predict()
+    #y_scores, y_preds = model.train_predict()
+    #model.get_metrics(y_scores, y_preds)
+    #model.plot_ROCs(y_scores)
+    #model.plot_PRs(y_scores)
@@ -1,9 +1,17 @@
 import numpy as np
 import pandas as pd
 import os
+import json
+import shutil
 import keras
-from utils.generator import Generator
+from concurrent.futures import ThreadPoolExecutor
+from utils.generator import PatchSequence, EmbeddingSequence, SplitSequence
+from utils.embedding_store import EmbeddingStore, build_embeddings, weights_hash
+from utils.aggregation import aggregate
 from utils.custom_fit_generator import custom_fit_generator
+from utils.step_stats import StepStats
+from utils.autoscale import LoaderAutoscaler
+from utils.data_parallel import train_data_parallel
 #from _Datasets import TCGA_Dataset
 from Datasets import Dataset
 from sklearn.metrics import accuracy_score, precision_score, recall_score, f1_score, roc_auc_score, average_precision_score, precision_recall_curve
@@ -28,27 +36,61 @@ import matplotlib.pyplot as plt
 
 class Model(object):
     
-    def __init__(self, config):
+    def __init__(self, config, partition=None):
         
         self.config = config
-        self.data_init()
+        self.data_init(partition)
         self.model_init()
         
-    def data_init(self):
+    def data_init(self, partition=None):
+        """
+        partition: (ids, labels) train/val/test partition to use instead of the random split of the dataset
+        """
         
         print("\nData init")
-        #self.dataset = TCGA_Dataset(self.config)
-        self.dataset = Dataset(self.config)
+        # imported on demand: SVS_Dataset needs openslide and cv2
+        if self.config.dataset == 'tcga':
+            from TCGA_Datasets import TCGA_Dataset
+            self.dataset = TCGA_Dataset(self.config)
+        elif self.config.dataset == 'svs':
+            from SVS_Datasets import SVS_Dataset
+            self.dataset = SVS_Dataset(self.config)
+        else:
+            self.dataset = Dataset(self.config)
+        if partition is not None:
+            self.dataset._partition = partition
+
+        self.train_generator = PatchSequence(self.config, self.dataset, seed=self.config.seed)
+        
+        # data-parallel training validates in the replicas: the parent never needs the decoded splits
+        if self.config.lazy_splits or self.config.parallel_workers > 1:
+            # nothing is decoded here: validation streams one patient at a time, prediction streams the test patients
+            self.val_split = SplitSequence(self.config, self.dataset, 'val', self.config.sampling_size_val, seed=self.config.seed, cache_dir=self.config.split_cache_dir)
+            self.test_split = SplitSequence(self.config, self.dataset, 'test', self.config.sampling_size_test, seed=self.config.seed, cache_dir=self.config.split_cache_dir)
+            self.y_val = self.val_split.y
+            self.y_test = self.patch_to_image(self.test_split.y, proba=False)
+            return
 
-        generator = Generator(self.config, self.dataset)
-        self.train_generator = generator.generate()
-        
         self.X_val, self.y_val = self.dataset.convert_to_arrays(self.dataset._partition[0]['val'], self.dataset._partition[1]['val'], phase = 'val',  size = self.config.sampling_size_val)
         
         self.X_test, self.y_test = self.dataset.convert_to_arrays(self.dataset._partition[0]['test'], self.dataset._partition[1]['test'], phase = 'test', size = self.config.sampling_size_test)
         
         self.y_test = self.patch_to_image(self.y_test, proba=False)   
 
+    def get_validation_data(self):
+        """
+        Validation data for custom_fit_generator: the streamed split, or for async validation
+        a memory-map of the split cache
+        """
+        if not self.config.lazy_splits:
+            return self.X_val, self.y_val
+        if not self.config.async_validation:
+            return self.val_split
+        if self.config.split_cache_dir is None:
+            # the validation process needs the whole split as arrays: in RAM, they would undo lazy_splits
+            raise ValueError("lazy_splits with async_validation needs a split_cache_dir")
+        return self.val_split.arrays()
+
     def plot_ROCs(self, y_scores):
         
         fig = plt.figure(figsize=(10,10))
@@ -89,12 +131,27 @@ class Model(object):
         self.base_model =  DenseNet169(include_top=False, weights='imagenet', input_shape=(224, 224,3), pooling= None)
         x = self.base_model.output
         x = GlobalAveragePooling2D()(x)
-        x = Dense(2048,  activation='relu', kernel_regularizer= l2(0.1))(x)
-        x = Dropout(0.30)(x, training = True)
-        x = Dense(100, activation='relu', kernel_regularizer= l2(0.1))(x)
-        x = Dropout(0.30)(x)
-        output = Dense(1,  activation='sigmoid')(x)
+        self.embedding_model = keras.models.Model(inputs=self.base_model.input, outputs=x)
+        self.head_layers = [Dense(2048,  activation='relu', kernel_regularizer= l2(0.1)), Dropout(0.30),
+                            Dense(100, activation='relu', kernel_regularizer= l2(0.1)), Dropout(0.30),
+                            Dense(1,  activation='sigmoid')]
+        output = self.apply_head(x)
         self.model = keras.models.Model(inputs=self.base_model.input, outputs=output)
+        self.head_model = None
+        
+    def apply_head(self, x):
+        'The dense head on pooled embeddings: the first Dropout is always active, the second only in training'
+        dense_1, dropout_1, dense_2, dropout_2, dense_3 = self.head_layers
+        x = dropout_1(dense_1(x), training = True)
+        x = dropout_2(dense_2(x))
+        return dense_3(x)
+
+    def get_head_model(self):
+        'The head as a model on (patches, features) embeddings, sharing its layers and weights with self.model'
+        if self.head_model is None:
+            inputs = keras.layers.Input(shape=(self.embedding_model.output_shape[-1],))
+            self.head_model = keras.models.Model(inputs=inputs, outputs=self.apply_head(inputs))
+        return self.head_model
         
         
     def set_trainable(self, from_idx=0):
@@ -104,16 +161,142 @@ class Model(object):
         #   layer.trainable = False
         for layer in self.model.layers[0:]:
             layer.trainable = True
+        if self.config.train_head_only:
+            for layer in self.base_model.layers:
+                layer.trainable = False
+
+    def get_callbacks(self):
+        'Early stopping on val_loss, except with async_validation: its val_loss is one epoch late, and missing at the first'
+        if self.config.async_validation:
+            return []
+        return [EarlyStopping(monitor='val_loss', min_delta=0, patience=5, verbose=0, mode='auto')]
 
     def train(self, lr=1e-4, epochs=10, from_idx=0):
         
+        if self.config.train_head_only:
+            return self.train_head(lr, epochs)
+        if self.config.parallel_workers > 1:
+            return self.train_parallel(lr, epochs)
         self.set_trainable()
         optimizer = Adam(lr=lr, beta_1=0.9, beta_2=0.999, epsilon=1e-08, decay=self.config.lr_decay)
         self.model.compile(optimizer=optimizer, loss='binary_crossentropy', metrics = ['accuracy'])
-        train_steps = len(self.dataset._partition[0]['train'])/self.config.batch_size
-        early_stopping = EarlyStopping(monitor='val_loss', min_delta=0, patience=5, verbose=0, mode='auto')
-        self.history = custom_fit_generator(model=self.model, generator=self.train_generator, steps_per_epoch=train_steps, epochs=epochs, verbose=1, validation_data=(self.X_val, self.y_val), shuffle=True, max_queue_size=30, workers=30, use_multiprocessing=True, callbacks=[early_stopping])
+        train_steps = len(self.train_generator)
+        autoscaler = None
+        if self.config.autoscale_loader and self.config.shared_memory:
+            memory_limit = self.config.loader_memory_gb * 2 ** 30 if self.config.loader_memory_gb else None
+            autoscaler = LoaderAutoscaler(self.config.min_workers, self.config.max_workers, self.config.min_queue, self.config.max_queue, memory_limit)
+        self.history = custom_fit_generator(model=self.model, generator=self.train_generator, steps_per_epoch=train_steps, epochs=epochs, verbose=1, validation_data=self.get_validation_data(), shuffle=True, max_queue_size=30, workers=30, use_multiprocessing=True, callbacks=self.get_callbacks(), shared_memory=self.config.shared_memory, step_stats=StepStats(self.config.step_trace), autoscaler=autoscaler, async_validation=self.config.async_validation, validation_device=self.config.validation_device)
     
+    def train_parallel(self, lr=1e-4, epochs=10):
+        """
+        Data-parallel training on parallel_workers CPU processes, each with a replica of the model and a shard of every batch;
+        the final weights are loaded back into self.model
+        """
+        n_weights = int(sum(w.size for w in self.model.get_weights()))
+        directory = train_data_parallel(self.config, lr, epochs, self.config.parallel_workers, n_weights, self.dataset._partition, threads=self.config.parallel_threads)
+        try:
+            self.model.load_weights(os.path.join(directory, 'weights.h5'))
+            self.history = keras.callbacks.History()
+            with open(os.path.join(directory, 'history.json')) as f:
+                self.history.history = json.load(f)
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    def get_embedding_store(self, phase = 'train'):
+        """
+        Embeddings of every manifest patch of a phase for the current backbone weights, computed on first use
+        """
+        root, patch_store = self.dataset.get_manifest_root(phase)
+        manifest = self.dataset.get_manifest(root)
+        # rows are manifest rows: key on the manifest content too, so a rebuilt manifest gets its own store
+        directory = os.path.join(self.config.embedding_dir, weights_hash(self.embedding_model),
+                                 "%s_%s" % (os.path.basename(root.rstrip("/")), manifest.digest()))
+        store = EmbeddingStore(directory, int(manifest.offsets[-1]), self.embedding_model.output_shape[-1])
+        build_embeddings(store, self.dataset, root, patch_store, self.embedding_model, self.config.feat_batch_size)
+        return manifest, store
+
+    def train_head(self, lr=1e-4, epochs=10):
+        """
+        Trains only the dense head, from cached backbone embeddings: the backbone is frozen and never run
+        """
+        if not self.config.use_manifest:
+            # embedding store rows are manifest rows
+            raise ValueError("train_head_only needs use_manifest")
+        self.set_trainable()
+        manifest, store = self.get_embedding_store('train')
+
+        # the head layers are shared with self.model, which is therefore updated too
+        self.get_head_model()
+        optimizer = Adam(lr=lr, beta_1=0.9, beta_2=0.999, epsilon=1e-08, decay=self.config.lr_decay)
+        self.head_model.compile(optimizer=optimizer, loss='binary_crossentropy', metrics = ['accuracy'])
+
+        partition_ids, partition_labels = self.dataset._partition
+        generator = EmbeddingSequence(self.config, manifest, store, partition_ids['train'], partition_labels['train'], seed=self.config.seed)
+        X_val = store.read(manifest.sample(partition_ids['val'], self.config.sampling_size_val,
+                                           random_state=np.random.RandomState(self.config.seed)))
+        y_val = np.repeat(partition_labels['val'], self.config.sampling_size_val)
+        self.history = custom_fit_generator(model=self.head_model, generator=generator, steps_per_epoch=len(generator), epochs=epochs, verbose=1, validation_data=(X_val, y_val), shuffle=True, max_queue_size=10, workers=1, use_multiprocessing=False, callbacks=self.get_callbacks(), step_stats=StepStats(self.config.step_trace), async_validation=self.config.async_validation, validation_device=self.config.validation_device)
+
+    def load_patches(self, sample, label, size, phase = 'train'):
+        X, _ = self.dataset.convert_to_arrays([sample], [label], phase = phase, size = size)
+        return X
+
+    def stream_patches(self, ids, labels, size, phase = 'train'):
+        """
+        Yields (patient index, patches) chunks of at most feat_batch_size patches, size per patient;
+        the next chunk is loaded on a background thread while the current one is scored
+        """
+        chunks = [(p, min(self.config.feat_batch_size, size - start)) for p in range(len(ids))
+                  for start in range(0, size, self.config.feat_batch_size)]
+
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            future = executor.submit(self.load_patches, ids[chunks[0][0]], labels[chunks[0][0]], chunks[0][1], phase) if chunks else None
+            for k, (p, n) in enumerate(chunks):
+                X = future.result()
+                if k + 1 < len(chunks):
+                    q, m = chunks[k + 1]
+                    future = executor.submit(self.load_patches, ids[q], labels[q], m, phase)
+                yield p, X
+
+    def stream_patches_adaptive(self, ids, labels, phase = 'train'):
+        """
+        Like stream_patches, but in rounds of adaptive_round patches per patient: after each round the
+        consumer sends True to stop sampling the current patient, which is also stopped at sample_size_feat patches.
+        The next round of the same patient is loaded speculatively while the current one is scored.
+        """
+        config = self.config
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            for p in range(len(ids)):
+                drawn = min(config.adaptive_round, config.sample_size_feat)
+                future = executor.submit(self.load_patches, ids[p], labels[p], drawn, phase)
+                while future is not None:
+                    X = future.result()
+                    future = None
+                    if drawn < config.sample_size_feat:
+                        n = min(config.adaptive_round, config.sample_size_feat - drawn)
+                        future = executor.submit(self.load_patches, ids[p], labels[p], n, phase)
+                        drawn += n
+                    stop = yield p, X
+                    if stop and future is not None:
+                        future.cancel()
+                        future = None
+
+    def score_patches(self, X, n_passes, intermediate_layer_model):
+        'Monte-Carlo dropout outputs (n_passes, patches, outputs)'
+        if self.config.mc_head:
+            return self.mc_head(self.embedding_model.predict(X), n_passes)
+        return np.stack([intermediate_layer_model.predict(X) for i in range(n_passes)])
+
+    def mc_head(self, embeddings, n_samples):
+        """
+        Monte-Carlo dropout samples of the head for pooled backbone embeddings (patches, features):
+        the embeddings tiled n_samples times go through the head model in one predict, which keeps the
+        always-active Dropout of self.model sampling. Returns (n_samples, patches, outputs).
+        """
+        tiled = np.tile(embeddings, (n_samples, 1))
+        outputs = self.get_head_model().predict(tiled, batch_size=self.config.feat_batch_size)
+        return outputs.reshape((n_samples, len(embeddings)) + outputs.shape[1:])
+
     def predict(self):
         
         df = self.dataset.get_binarized_data()
@@ -121,19 +304,61 @@ class Model(object):
         labels = df.values
                 
         print("\nPredicting")
-        intermediate_layer_model= keras.models.Model(inputs=self.base_model.input, outputs= self.model.layers[-1].output)
-        
-        self.X_feat, self.y_feat = self.dataset.convert_to_arrays(list(ids), labels, phase = 'train',  size = self.config.sample_size_feat)
-        
-        ids = np.asarray(ids)
-        ids = np.repeat(ids, self.config.sample_size_feat)
-        
-        
-        for i in range(10):
-            intermediate_output = intermediate_layer_model.predict(self.X_feat)
-            features = pd.DataFrame(data = intermediate_output, index = ids)
-            features["ids"] = ids
-            features = features.groupby(["ids"]).mean()
+        # self.model.output, not the last layer's output: the head layers also have an inbound node in the head model
+        intermediate_layer_model= keras.models.Model(inputs=self.base_model.input, outputs= self.model.output)
+        
+        # running per-patient sums: only one chunk of patches is in memory at a time with the mean aggregation
+        n_passes = self.config.mc_samples
+        n_outputs = self.model.output_shape[-1]
+        sums = np.zeros((n_passes, len(ids), n_outputs))
+        counts = np.zeros(len(ids))
+        # other aggregations than the mean need every patch score: kept per chunk with its patient index
+        keep_patches = self.config.aggregation != 'mean'
+        patch_chunks, patch_segments = [], []
+        if self.config.adaptive_sampling:
+            # sum and sum of squares of the per-patch score, averaged over the passes, for the confidence interval
+            score_sums = np.zeros(len(ids))
+            score_squares = np.zeros(len(ids))
+            stream = self.stream_patches_adaptive(list(ids), labels)
+            stop = None
+            while True:
+                try:
+                    p, X = stream.send(stop)
+                except StopIteration:
+                    break
+                scores = self.score_patches(X, n_passes, intermediate_layer_model)
+                sums[:, p] += scores.sum(axis=1)
+                counts[p] += len(X)
+                if keep_patches:
+                    patch_chunks.append(scores.astype(np.float32))
+                    patch_segments.append(np.full(len(X), p))
+                patch_scores = scores[..., 0].mean(axis=0)
+                score_sums[p] += patch_scores.sum()
+                score_squares[p] += (patch_scores ** 2).sum()
+                n = counts[p]
+                variance = max(score_squares[p] / n - (score_sums[p] / n) ** 2, 0.) * n / max(n - 1, 1)
+                half_width = self.config.adaptive_z * np.sqrt(variance / n)
+                stop = n >= self.config.adaptive_min and half_width <= self.config.adaptive_tol
+            print("adaptive sampling: %.1f patches per patient on average (%d to %d)" % (counts.mean(), counts.min(), counts.max()))
+        else:
+            for p, X in self.stream_patches(list(ids), labels, self.config.sample_size_feat):
+                scores = self.score_patches(X, n_passes, intermediate_layer_model)
+                sums[:, p] += scores.sum(axis=1)
+                counts[p] += len(X)
+                if keep_patches:
+                    patch_chunks.append(scores.astype(np.float32))
+                    patch_segments.append(np.full(len(X), p))
+        
+        if keep_patches:
+            patch_scores = np.concatenate(patch_chunks, axis=1)
+            segments = np.concatenate(patch_segments)
+            patient_scores = np.stack([np.stack([self.patch_to_image(patch_scores[i, :, j], segments=segments, n_segments=len(ids))
+                                                 for j in range(n_outputs)], axis=-1) for i in range(n_passes)])
+        else:
+            patient_scores = sums / counts[None, :, None]
+        for i in range(n_passes):
+            features = pd.DataFrame(data = patient_scores[i].astype(np.float32), index = pd.Index(np.asarray(ids), name = "ids"))
+            features = features.sort_index()
             features.to_csv("pathology_scores_%s.csv"%i) 
         
  #       intermediate_output = intermediate_layer_model.predict(self.X_test, batch_size= self.config.batch_size)
@@ -162,13 +387,21 @@ class Model(object):
         
        # return y_scores, y_preds
     
-    def patch_to_image(self, y_patches, proba=True):
-        
-        if proba == True:
-            y_image = np.array([np.mean(y_patches[i*self.config.sampling_size_test:(i+1)*self.config.sampling_size_test])for i in range(int(len(y_patches)/self.config.sampling_size_test))]).reshape((-1,1))
-        else:
-            y_image = np.array([np.mean(y_patches[i*self.config.sampling_size_test:(i+1)*self.config.sampling_size_test])>0.5 for i in range(int(len(y_patches)/self.config.sampling_size_test))]).reshape((-1,1)).astype(int)
-        y_image = np.asarray(y_image.flatten())
+    def patch_to_image(self, y_patches, proba=True, segments=None, n_segments=None):
+        """
+        Aggregates patch scores into patient scores with Config.aggregation.
+        segments gives the patient index of each patch; by default patients are consecutive blocks of sampling_size_test
+        n_segments is the number of patients, when the last ones may have no patch
+        """
+        if segments is None:
+            n_images = int(len(y_patches)/self.config.sampling_size_test)
+            y_patches = y_patches[:n_images*self.config.sampling_size_test]
+            segments = np.arange(len(y_patches)) // self.config.sampling_size_test
+        y_image = aggregate(y_patches, segments, method=self.config.aggregation, n_segments=n_segments,
+                            trim=self.config.aggregation_trim,
+                            k=self.config.aggregation_k, q=self.config.aggregation_q)
+        if proba == False:
+            y_image = (y_image > 0.5).astype(int)
         return y_image
     
     def plot_loss(self):
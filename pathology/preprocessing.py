@@ -1,45 +1,412 @@
 import numpy as np
 import os
 import shutil
+import socket
+import time
 import PIL.ImageOps
+from PIL import Image
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from openslide import *
 from scipy.ndimage.morphology import binary_dilation
 from multiprocessing import Pool
 from config import Config
+from utils.patch_store import PatchStoreWriter
 import cv2
 
 
-def get_patches(patient_id, config):
-    if os.path.isdir("/labs/gevaertlab/data/MICCAI/patches_448_test/%s"%patient_id):
-        print ("sample already processed")
-        return
-    if os.path.isdir("/labs/gevaertlab/data/MICCAI/temp/%s"% patient_id):
-        shutil.rmtree("/labs/gevaertlab/data/MICCAI/temp/%s"% patient_id)
-    os.makedirs("/labs/gevaertlab/data/MICCAI/temp/%s"% patient_id)
-    img = OpenSlide("/labs/gevaertlab/data/MICCAI/pathology_test/%s.svs"% patient_id)
+def tissue_score(array):
+    gray = cv2.cvtColor(array, cv2.COLOR_BGR2GRAY)
+    ret, thresh = cv2.threshold(gray,0,255,cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
+    thresh = binary_dilation(thresh, iterations=15)
+    ratio = np.mean(thresh)
+    return ret, ratio
+
+def otsu_thresholds(gray):
+    """
+    Otsu threshold of each tile of a (n, h, w) uint8 stack, as cv2.THRESH_OTSU computes it
+    """
+    n = gray.shape[0]
+    offsets = np.arange(n, dtype=np.int64)[:, None] * 256
+    hist = np.bincount((gray.reshape(n, -1) + offsets).ravel(), minlength=n*256).reshape(n, 256)
+    p = hist / float(gray[0].size)
+    levels = np.arange(256, dtype=np.float64)
+    q1 = np.cumsum(p, axis=1)
+    q2 = 1. - q1
+    m1 = np.cumsum(p * levels, axis=1)
+    mu = m1[:, -1:]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mu1 = m1 / q1
+        mu2 = (mu - m1) / q2
+        sigma = q1 * q2 * (mu1 - mu2) ** 2
+    eps = np.finfo(np.float32).eps
+    sigma[(np.minimum(q1, q2) < eps) | (np.maximum(q1, q2) > 1. - eps)] = -1.
+    # first maximum, like the strict comparison in OpenCV
+    return np.where(sigma.max(axis=1) > 0, np.argmax(sigma, axis=1), 0).astype(np.float64)
+
+def tissue_scores(tiles):
+    """
+    Vectorized tissue_score over a (n, h, w, 3) stack of tiles
+    """
+    n, h, w, _ = tiles.shape
+    gray = cv2.cvtColor(tiles.reshape(n*h, w, 3), cv2.COLOR_BGR2GRAY).reshape(n, h, w)
+    ret = otsu_thresholds(gray)
+    thresh = gray <= ret[:, None, None]
+    # dilate every tile independently: no connectivity along the tile axis
+    structure = np.zeros((3, 3, 3), dtype=bool)
+    structure[1] = [[0, 1, 0], [1, 1, 1], [0, 1, 0]]
+    thresh = binary_dilation(thresh, structure=structure, iterations=15)
+    ratio = thresh.reshape(n, -1).mean(axis=1)
+    return ret, ratio
+
+def get_tissue_mask(img, config):
+    """
+    Otsu tissue mask computed once on a thumbnail of the slide, reduced to one boolean
+    per patch_size grid cell (True where the fraction of tissue exceeds mask_threshold)
+    """
     width, height = img.dimensions
-    idx = 0
-    for i in range(int(height/config.patch_size)):
-        print ("iteration %d out of %d"%(i+1,int(height/config.patch_size)))
-        for j in range(int(width/config.patch_size)):
-            patch = img.read_region(location=(j*config.patch_size,i*config.patch_size), level=0,
+    n_rows, n_cols = int(height/config.patch_size), int(width/config.patch_size)
+    cell = config.mask_cell_size
+    downsample = float(config.patch_size) / cell
+    thumbnail = img.get_thumbnail((int(width/downsample), int(height/downsample))).convert('RGB')
+    gray = cv2.cvtColor(np.array(thumbnail), cv2.COLOR_RGB2GRAY)
+    _, thresh = cv2.threshold(gray,0,255,cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
+    # map the thumbnail back onto the level 0 grid with exactly mask_cell_size pixels per cell
+    thresh = cv2.resize(thresh, (int(width/downsample), int(height/downsample)), interpolation=cv2.INTER_NEAREST)
+    thresh = thresh[:n_rows*cell, :n_cols*cell]
+    ratio = (thresh > 0).reshape(n_rows, cell, n_cols, cell).mean(axis=(1, 3))
+    return ratio > config.mask_threshold
+
+def scale_name(scale):
+    return "x%g"% scale
+
+def resize_tile(tile, size):
+    if tile.shape[0] == size:
+        return tile
+    return np.array(Image.fromarray(tile).resize((size, size)))
+
+def save_tile(tile, path, size):
+    Image.fromarray(resize_tile(tile, size)).save(path)
+
+
+class PatchWriter(object):
+    """
+    Encodes and writes accepted tiles on a bounded thread pool so that the next strip
+    can be read meanwhile; results are committed in submission order.
+    Scale 1 goes to directory and every other scale s to directory/x<s>, with the same
+    tile indexes so that the scales stay co-registered.
+    After the tiles of row i are committed a progress marker progress/row_i.npz is written,
+    so an interrupted slide resumes after its last completed row.
+    """
+
+    def __init__(self, directory, config, on_row=None):
+        self.directory = directory
+        self.packed = config.patch_format == 'packed'
+        self.size = config.input_shape if self.packed else config.patch_size
+        self.scales = get_scales(config)
+        self.directories = dict((scale, directory if scale == 1 else os.path.join(directory, scale_name(scale)))
+                                for scale in self.scales)
+        self.on_row = on_row
+        self.executor = ThreadPoolExecutor(max_workers=config.write_workers)
+        self.max_pending = config.write_queue
+        self.pending = deque()
+        self.progress_dir = os.path.join(directory, "progress")
+        self.last_row = self.resume()
+        self._row_coords, self._row_scores = [], []
+
+    def resume(self):
+        'Reloads the progress markers of an interrupted run and drops tiles written after the last one'
+        coords, scores, last_row = [np.zeros((0, 2), dtype=np.int64)], [np.zeros(0, dtype=np.float32)], -1
+        if os.path.isdir(self.progress_dir):
+            for name in os.listdir(self.progress_dir):
+                if not name.endswith(".npz"):
+                    continue
+                with np.load(os.path.join(self.progress_dir, name)) as marker:
+                    coords.append(marker['coords'])
+                    scores.append(marker['scores'])
+                    last_row = max(last_row, int(marker['row']))
+        else:
+            os.makedirs(self.progress_dir)
+        # markers are written in row order, so sort the tiles back by row then column
+        coords, scores = np.concatenate(coords), np.concatenate(scores)
+        order = np.lexsort((coords[:, 0], coords[:, 1]))
+        coords, scores = coords[order], scores[order]
+        self.count = len(coords)
+        self.stores = {}
+        for scale, directory in self.directories.items():
+            if self.packed:
+                self.stores[scale] = PatchStoreWriter(directory, self.size, coords, scores)
+                continue
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            for name in os.listdir(directory):
+                if name.endswith(".jpg") and int(name[:-4]) >= self.count:
+                    os.remove(os.path.join(directory, name))
+        if last_row >= 0:
+            print ("resuming after row %d with %d tiles"%(last_row, self.count))
+        return last_row
+
+    def submit(self, tiles, x, y, score=np.nan):
+        'tiles: one array per scale, in the order of self.scales'
+        futures = []
+        for scale, tile in zip(self.scales, tiles):
+            if self.packed:
+                futures.append(self.executor.submit(resize_tile, tile, self.size))
+            else:
+                path = "%s/%s.jpg"% (self.directories[scale], self.count)
+                futures.append(self.executor.submit(save_tile, tile, path, self.size))
+        self.pending.append((futures, x, y, score))
+        self.count += 1
+        while len(self.pending) > self.max_pending:
+            self._commit()
+        self._commit_done()
+
+    def mark_row(self, i):
+        self.pending.append((None, i, None, None))
+        self._commit_done()
+
+    def _commit_done(self):
+        while self.pending and (self.pending[0][0] is None or all(f.done() for f in self.pending[0][0])):
+            self._commit()
+
+    def _commit(self):
+        futures, x, y, score = self.pending.popleft()
+        if futures is None:
+            self._write_marker(x)
+            return
+        for scale, future in zip(self.scales, futures):
+            result = future.result()
+            if self.packed:
+                self.stores[scale].add(result, x, y, score)
+        self._row_coords.append((x, y))
+        self._row_scores.append(score)
+
+    def _write_marker(self, i):
+        for store in self.stores.values():
+            store.flush()
+        path = os.path.join(self.progress_dir, "row_%d.npz"% i)
+        with open(path + ".tmp", "wb") as f:
+            np.savez(f, row=i, coords=np.asarray(self._row_coords, dtype=np.int64).reshape((-1, 2)),
+                     scores=np.asarray(self._row_scores, dtype=np.float32))
+        os.rename(path + ".tmp", path)
+        self._row_coords, self._row_scores = [], []
+        self.last_row = i
+        if self.on_row is not None:
+            self.on_row(i)
+
+    def close(self):
+        while self.pending:
+            self._commit()
+        self.executor.shutdown()
+        for store in self.stores.values():
+            store.close()
+        shutil.rmtree(self.progress_dir)
+
+
+def get_scales(config):
+    'Scale 1 (the patch_size grid at level 0) is always written first, then the other configured scales'
+    return [1] + sorted(scale for scale in config.scales if scale != 1)
+
+def read_strip(img, i, j0, j1, patch_size):
+    """
+    Reads tiles (i, j0) ... (i, j1 - 1) with a single read_region and slices them
+    into a (j1 - j0, patch_size, patch_size, 3) array
+    """
+    region = img.read_region(location=(j0*patch_size, i*patch_size), level=0,
+                             size=((j1-j0)*patch_size, patch_size)).convert('RGB')
+    strip = np.array(region)
+    tiles = strip.reshape(patch_size, j1-j0, patch_size, 3).transpose(1, 0, 2, 3)
+    return np.ascontiguousarray(tiles)
+
+def read_context_strip(img, i, j0, j1, scale, patch_size):
+    """
+    Reads the (scale * patch_size)-wide context around tiles (i, j0) ... (i, j1 - 1) with a single
+    read_region on the pyramid level closest to the scale, sliced into one array per tile
+    """
+    level = img.get_best_level_for_downsample(scale)
+    downsample = img.level_downsamples[level]
+    margin = int((scale - 1) * patch_size / 2)
+    size = int(round(scale * patch_size / downsample))
+    offsets = [int(round(k * patch_size / downsample)) for k in range(j1 - j0)]
+    region = img.read_region(location=(j0*patch_size - margin, i*patch_size - margin), level=level,
+                             size=(offsets[-1] + size, size)).convert('RGB')
+    strip = np.array(region)
+    return [strip[:, offset:offset+size] for offset in offsets]
+
+def get_scaled_tiles(img, tiles, i, j0, j1, keep, config):
+    """
+    Co-registered tiles at every scale for the kept tiles of a strip: scales below 1 are
+    center crops of the tiles already read, scales above 1 come from one context read per strip
+    """
+    scaled = []
+    for scale in get_scales(config):
+        if scale == 1:
+            scaled.append([tiles[k] for k in keep])
+        elif scale < 1:
+            crop = int(round(scale * config.patch_size))
+            offset = (config.patch_size - crop) // 2
+            scaled.append([tiles[k][offset:offset+crop, offset:offset+crop] for k in keep])
+        else:
+            context = read_context_strip(img, i, j0, j1, scale, config.patch_size)
+            scaled.append([context[k] for k in keep])
+    return list(zip(*scaled))
+
+def get_runs(row, strip_tiles):
+    """
+    Contiguous runs of tissue cells in a row of the mask, split into at most strip_tiles cells
+    """
+    edges = np.flatnonzero(np.diff(np.concatenate([[0], row.astype(np.int8), [0]])))
+    runs = []
+    for j0, j1 in zip(edges[::2], edges[1::2]):
+        for start in range(j0, j1, strip_tiles):
+            runs.append((start, min(start + strip_tiles, j1)))
+    return runs
+
+def extract_strips(img, mask, writer, config):
+    n_read = 0
+    for i in range(writer.last_row + 1, mask.shape[0]):
+        for j0, j1 in get_runs(mask[i], config.strip_tiles):
+            tiles = read_strip(img, i, j0, j1, config.patch_size)
+            n_read += len(tiles)
+            if config.patch_check:
+                ret, scores = tissue_scores(tiles)
+                keep = np.flatnonzero((ret < 200) & (scores > 0.80))
+            else:
+                scores = np.full(len(tiles), np.nan)
+                keep = np.arange(len(tiles))
+            if len(keep) == 0:
+                continue
+            for k, scaled in zip(keep, get_scaled_tiles(img, tiles, i, j0, j1, keep, config)):
+                writer.submit(scaled, (j0+k)*config.patch_size, i*config.patch_size, scores[k])
+        writer.mark_row(i)
+    return n_read
+
+def extract_tiles(img, mask, writer, config):
+    n_read = 0
+    for i in range(writer.last_row + 1, mask.shape[0]):
+        for j in np.flatnonzero(mask[i]):
+            x, y = j*config.patch_size, i*config.patch_size
+            patch = img.read_region(location=(x,y), level=0,
                                     size=(config.patch_size,config.patch_size)).convert('RGB')
-            array = np.array(patch)[:,:,:3]    
-            gray = cv2.cvtColor(array, cv2.COLOR_BGR2GRAY)
-            ret, thresh = cv2.threshold(gray,0,255,cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
-            thresh = binary_dilation(thresh, iterations=15)
-            ratio = np.mean(thresh)
-            if ret < 200 and ratio > 0.80:
-                patch.save("/labs/gevaertlab/data/MICCAI/temp/%s/%s.jpg"% (patient_id, idx))
-                idx += 1
-    shutil.move("/labs/gevaertlab/data/MICCAI/temp/%s"% patient_id, "/labs/gevaertlab/data/MICCAI/patches_448_test/%s"% patient_id)
+            array = np.array(patch)[:,:,:3]
+            n_read += 1
+            score = np.nan
+            if config.patch_check:
+                ret, score = tissue_score(array)
+                if not (ret < 200 and score > 0.80):
+                    continue
+            scaled, = get_scaled_tiles(img, array[np.newaxis], i, j, j+1, [0], config)
+            writer.submit(scaled, x, y, score)
+        writer.mark_row(i)
+    return n_read
+
+
+DATA_DIR = "/labs/gevaertlab/data/MICCAI"
+SLIDE_DIR = DATA_DIR + "/pathology_test"
+TEMP_DIR = DATA_DIR + "/temp"
+LOCK_DIR = DATA_DIR + "/locks"
+OUTPUT_DIRS = {'jpeg': DATA_DIR + "/patches_448_test",
+               'packed': DATA_DIR + "/packed_224_test"}
+
+def claim_slide(patient_id, lock_timeout):
+    """
+    Atomically claims a slide with an O_EXCL lock file on the shared filesystem.
+    A lock whose heartbeat is older than lock_timeout seconds is considered abandoned and broken.
+    """
+    lock_path = "%s/%s.lock"% (LOCK_DIR, patient_id)
+    for _ in range(2):
+        try:
+            fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except OSError:
+            try:
+                age = time.time() - os.path.getmtime(lock_path)
+            except OSError:
+                continue
+            if age < lock_timeout:
+                return None
+            # only one of the competing nodes wins the rename of a stale lock
+            stale_path = "%s.stale.%s.%d"% (lock_path, socket.gethostname(), os.getpid())
+            try:
+                os.rename(lock_path, stale_path)
+            except OSError:
+                return None
+            os.remove(stale_path)
+            continue
+        os.write(fd, ("%s %d %f\n"% (socket.gethostname(), os.getpid(), time.time())).encode())
+        os.close(fd)
+        return lock_path
+    return None
+
+def release_slide(lock_path):
+    if os.path.isfile(lock_path):
+        os.remove(lock_path)
+
+def get_patches(patient_id, config):
+    output_dir = OUTPUT_DIRS[config.patch_format]
+    if os.path.isdir("%s/%s"% (output_dir, patient_id)):
+        return "%s: already processed"% patient_id
+    lock_path = claim_slide(patient_id, config.lock_timeout)
+    if lock_path is None:
+        return "%s: claimed by another worker"% patient_id
+    try:
+        # another node may have finished it between the check and the claim
+        if os.path.isdir("%s/%s"% (output_dir, patient_id)):
+            return "%s: already processed"% patient_id
+        temp_dir = "%s/%s"% (TEMP_DIR, patient_id)
+        if os.path.isdir(temp_dir) and not os.path.isdir(temp_dir + "/progress"):
+            shutil.rmtree(temp_dir)
+        if not os.path.isdir(temp_dir):
+            os.makedirs(temp_dir)
+        img = OpenSlide("%s/%s.svs"% (SLIDE_DIR, patient_id))
+        width, height = img.dimensions
+        n_rows, n_cols = int(height/config.patch_size), int(width/config.patch_size)
+        start = time.time()
+        if config.tissue_mask:
+            mask = get_tissue_mask(img, config)
+            print ("%d tissue cells out of %d"%(mask.sum(), mask.size))
+        else:
+            mask = np.ones((n_rows, n_cols), dtype=bool)
+        # heartbeat on the lock after every completed row
+        writer = PatchWriter(temp_dir, config, on_row=lambda i: os.utime(lock_path, None))
+        if config.strip_reads:
+            n_read = extract_strips(img, mask, writer, config)
+        else:
+            n_read = extract_tiles(img, mask, writer, config)
+        writer.close()
+        elapsed = time.time() - start
+        print ("%s: %d tiles read, %d kept in %.1fs (%.1f tiles/sec, %s)"%(patient_id, n_read, writer.count, elapsed,
+                                                                           n_read/max(elapsed, 1e-6), "strips" if config.strip_reads else "tiles"))
+        # the other scales first: the scale 1 directory is what marks the slide as processed
+        for scale in get_scales(config)[1:]:
+            scale_dir = "%s_%s"% (output_dir, scale_name(scale))
+            if not os.path.isdir(scale_dir):
+                os.makedirs(scale_dir)
+            shutil.move("%s/%s"% (temp_dir, scale_name(scale)), "%s/%s"% (scale_dir, patient_id))
+        shutil.move(temp_dir, "%s/%s"% (output_dir, patient_id))
+        return "%s: done"% patient_id
+    finally:
+        release_slide(lock_path)
+
+def get_patches_star(args):
+    return get_patches(*args)
 
 def get_all_patches(config, processes=30):
-    
-    patient_ids = os.listdir("/labs/gevaertlab/data/MICCAI/pathology_test/")
-    patient_ids = [patient_id[:-4] for patient_id in patient_ids]    
+    """
+    Hands slides out one at a time, largest first, so that big slides do not end up
+    on a few busy workers; several machines can run this at once on the shared filesystem
+    """
+    for directory in [TEMP_DIR, LOCK_DIR]:
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+    patient_ids = os.listdir(SLIDE_DIR)
+    patient_ids = sorted(patient_ids, key=lambda name: os.path.getsize("%s/%s"% (SLIDE_DIR, name)), reverse=True)
+    patient_ids = [patient_id[:-4] for patient_id in patient_ids]
     p = Pool(processes)
-    p.starmap(get_patches, [(patient_id, config) for patient_id in patient_ids])
+    for status in p.imap_unordered(get_patches_star, [(patient_id, config) for patient_id in patient_ids], chunksize=1):
+        print (status)
+    p.close()
+    p.join()
 
-config = Config()
-get_all_patches(config)
\ No newline at end of file
+if __name__ == '__main__':
+    config = Config()
+    get_all_patches(config)
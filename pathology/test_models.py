@@ -0,0 +1,72 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+keras = pytest.importorskip("keras")
+
+import models
+from config import Config
+
+
+def tiny_backbone(include_top=False, weights=None, input_shape=(224, 224, 3), pooling=None):
+    'Stand-in for DenseNet169: a single strided convolution, no pretrained weights to download'
+    inputs = keras.layers.Input(shape=input_shape)
+    outputs = keras.layers.Conv2D(4, 3, strides=32)(inputs)
+    return keras.models.Model(inputs=inputs, outputs=outputs)
+
+
+class FakeDataset(object):
+
+    def __init__(self):
+        self._partition = ({'train': ['a', 'b'], 'val': ['c'], 'test': []}, {'train': [0, 1], 'val': [1], 'test': []})
+
+    def get_binarized_data(self):
+        return pd.DataFrame({'label': [0, 1]}, index=['a', 'b'])
+
+    def convert_to_arrays(self, samples, labels, phase='train', size=1):
+        return np.random.randint(0, 255, (len(samples) * size, 224, 224, 3)).astype(np.uint8), np.repeat(labels, size)
+
+
+class FakeManifest(object):
+
+    def sample(self, ids, size, random_state=None):
+        return np.arange(len(ids) * size)
+
+
+class FakeStore(object):
+
+    def __init__(self, dim):
+        self.dim = dim
+
+    def read(self, indexes):
+        return np.random.rand(len(indexes), self.dim).astype(np.float32)
+
+
+def fit_once(model, validation_data, **kwargs):
+    'Stand-in for custom_fit_generator: one epoch of the head on the validation embeddings'
+    X, y = validation_data
+    return model.fit(X, y, epochs=1, verbose=0)
+
+
+@pytest.mark.parametrize("mc_head", [True, False])
+def test_predict_after_train_head(tmp_path, monkeypatch, mc_head):
+    monkeypatch.chdir(str(tmp_path))
+    monkeypatch.setattr(models, "DenseNet169", tiny_backbone)
+    monkeypatch.setattr(models, "custom_fit_generator", fit_once)
+    config = Config(train_head_only=True, use_manifest=True, mc_head=mc_head, mc_samples=2, sample_size_feat=3, feat_batch_size=2,
+                    sampling_size_val=4, step_trace=None)
+
+    model = models.Model.__new__(models.Model)
+    model.config = config
+    model.dataset = FakeDataset()
+    model.model_init()
+    dim = model.embedding_model.output_shape[-1]
+    monkeypatch.setattr(model, "get_embedding_store", lambda phase='train': (FakeManifest(), FakeStore(dim)))
+
+    model.train_predict()
+
+    for i in range(config.mc_samples):
+        scores = pd.read_csv("pathology_scores_%d.csv" % i, index_col=0)
+        assert list(scores.index) == ['a', 'b']
+        assert scores.shape == (2, 1)
+        assert np.all((scores.values >= 0) & (scores.values <= 1))
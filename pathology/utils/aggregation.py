@@ -0,0 +1,70 @@
+import numpy as np
+
+
+def segment_counts(segments, n_segments=None):
+    segments = np.asarray(segments, dtype=np.int64)
+    if n_segments is None:
+        n_segments = int(segments.max()) + 1 if len(segments) else 0
+    return np.bincount(segments, minlength=n_segments)
+
+def segment_mean(values, segments, n_segments=None):
+    'Mean of the values of each segment (nan for empty segments)'
+    counts = segment_counts(segments, n_segments)
+    sums = np.bincount(segments, weights=values, minlength=len(counts))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return sums / counts
+
+def _sorted_segments(values, segments, n_segments=None):
+    """
+    Values sorted within each segment, with the segment counts, the start of each segment in the
+    sorted array and the rank of every sorted value within its segment
+    """
+    counts = segment_counts(segments, n_segments)
+    order = np.lexsort((values, segments))
+    sorted_values, sorted_segments = values[order], np.asarray(segments)[order]
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    ranks = np.arange(len(values)) - starts[sorted_segments]
+    return sorted_values, sorted_segments, counts, starts, ranks
+
+def segment_trimmed_mean(values, segments, trim=0.1, n_segments=None):
+    'Mean after dropping the floor(trim * count) lowest and highest values of each segment'
+    sorted_values, sorted_segments, counts, _, ranks = _sorted_segments(values, segments, n_segments)
+    cut = np.floor(trim * counts).astype(np.int64)
+    keep = (ranks >= cut[sorted_segments]) & (ranks < (counts - cut)[sorted_segments])
+    return segment_mean(sorted_values[keep], sorted_segments[keep], len(counts))
+
+def segment_topk_mean(values, segments, k=10, n_segments=None):
+    'Mean of the k highest values of each segment (all of them when a segment has fewer)'
+    sorted_values, sorted_segments, counts, _, ranks = _sorted_segments(values, segments, n_segments)
+    keep = ranks >= (counts - np.minimum(k, counts))[sorted_segments]
+    return segment_mean(sorted_values[keep], sorted_segments[keep], len(counts))
+
+def segment_quantile(values, segments, q=0.5, n_segments=None):
+    'q-th quantile of each segment, with linear interpolation like np.quantile (nan for empty segments)'
+    sorted_values, _, counts, starts, _ = _sorted_segments(values, segments, n_segments)
+    result = np.full(len(counts), np.nan)
+    full = counts > 0
+    position = q * (counts[full] - 1)
+    lower = np.floor(position).astype(np.int64)
+    upper = np.ceil(position).astype(np.int64)
+    low, high = sorted_values[starts[full] + lower], sorted_values[starts[full] + upper]
+    result[full] = low + (position - lower) * (high - low)
+    return result
+
+def aggregate(values, segments, method='mean', n_segments=None, trim=0.1, k=10, q=0.5):
+    """
+    Patient-level aggregation of patch values in one vectorised call.
+    values: (N,) or (N, 1) patch values, segments: (N,) patient index of each patch, groups may be ragged
+    method: 'mean', 'trimmed_mean', 'topk_mean' or 'quantile'
+    """
+    values = np.asarray(values, dtype=np.float64).reshape(len(segments))
+    segments = np.asarray(segments, dtype=np.int64)
+    if method == 'mean':
+        return segment_mean(values, segments, n_segments)
+    if method == 'trimmed_mean':
+        return segment_trimmed_mean(values, segments, trim, n_segments)
+    if method == 'topk_mean':
+        return segment_topk_mean(values, segments, k, n_segments)
+    if method == 'quantile':
+        return segment_quantile(values, segments, q, n_segments)
+    raise ValueError("Unknown aggregation %s"% method)
@@ -0,0 +1,96 @@
+import multiprocessing
+import os
+import queue
+import shutil
+import tempfile
+import traceback
+import numpy as np
+
+
+def _evaluate_worker(model_json, loss, metrics, x_path, y_path, batch_size, device, tasks, results):
+    # the evaluation process keeps away from the trainer GPU unless given one
+    os.environ['CUDA_VISIBLE_DEVICES'] = device
+    import keras
+    if device:
+        # the GPU may be the trainer's: only take the memory the evaluation needs
+        import tensorflow as tf
+        session_config = tf.ConfigProto()
+        session_config.gpu_options.allow_growth = True
+        keras.backend.set_session(tf.Session(config=session_config))
+    model = keras.models.model_from_json(model_json)
+    model.compile(optimizer='sgd', loss=loss, metrics=metrics)
+    x = np.load(x_path, mmap_mode='r')
+    y = np.load(y_path, mmap_mode='r')
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        epoch, weights = task
+        try:
+            model.set_weights(weights)
+            outs = model.evaluate(x, y, batch_size=batch_size, verbose=0)
+            results.put((epoch, outs if isinstance(outs, list) else [outs], None))
+        except Exception:
+            results.put((epoch, None, traceback.format_exc()))
+
+
+class AsyncValidator(object):
+    """
+    Evaluates weight snapshots of a model on in-memory validation data in a separate process,
+    so the trainer moves on to the next epoch while the previous one is validated.
+    The validation arrays are memory-mapped by the worker, from a temporary copy unless they already are
+    whole-file .npy memory-maps; each submit() only sends a copy of the weights.
+    device is the CUDA_VISIBLE_DEVICES of the worker: '' (CPU) keeps it off the trainer GPU, but a CPU evaluation
+    slower than a training epoch makes collect() block the trainer.
+    """
+
+    def __init__(self, model, val_x, val_y, batch_size=32, device=''):
+        self.directory = tempfile.mkdtemp(prefix='validation_')
+        x_path, y_path = self.save(val_x, 'x'), self.save(val_y, 'y')
+        # spawn: a fork would inherit the trainer TensorFlow session
+        context = multiprocessing.get_context('spawn')
+        self.tasks = context.Queue()
+        self.results = context.Queue()
+        self.process = context.Process(target=_evaluate_worker,
+                                       args=(model.to_json(), model.loss, model.metrics, x_path, y_path,
+                                             batch_size, device, self.tasks, self.results))
+        self.process.daemon = True
+        self.process.start()
+        self.pending = 0
+
+    def save(self, array, name):
+        if isinstance(array, np.memmap) and array.filename and array.filename.endswith('.npy'):
+            whole = np.load(array.filename, mmap_mode='r')
+            if whole.offset == array.offset and whole.shape == array.shape and whole.dtype == array.dtype:
+                return array.filename
+        path = os.path.join(self.directory, name + '.npy')
+        np.save(path, array)
+        return path
+
+    def submit(self, epoch, weights):
+        self.tasks.put((epoch, weights))
+        self.pending += 1
+
+    def collect(self):
+        'Blocks for the oldest submitted snapshot and returns (epoch, outs)'
+        while True:
+            try:
+                epoch, outs, error = self.results.get(timeout=1)
+                break
+            except queue.Empty:
+                if not self.process.is_alive():
+                    self.close()
+                    raise RuntimeError('Validation worker exited with code %s' % self.process.exitcode)
+        self.pending -= 1
+        if error is not None:
+            self.close()
+            raise RuntimeError('Validation worker failed:\n%s' % error)
+        return epoch, outs
+
+    def close(self):
+        if self.process.is_alive():
+            self.tasks.put(None)
+            self.process.join(60)
+            if self.process.is_alive():
+                self.process.terminate()
+        shutil.rmtree(self.directory, ignore_errors=True)
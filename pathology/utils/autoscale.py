@@ -0,0 +1,80 @@
+import multiprocessing
+import numpy as np
+
+
+class LoaderAutoscaler(object):
+    """
+    Resizes a running SharedMemoryEnqueuer from the StepStats of the training loop.
+    Every interval steps, over the last interval steps:
+    - the trainer waits on data (data_wait_ratio above starve_ratio) and the queue is nearly empty:
+      one more worker and two more slots, unless loader memory would exceed memory_limit (bytes of the
+      slots in circulation plus the private memory of the workers)
+    - the trainer never waits (below idle_ratio) and the queue stays mostly full: one worker and one slot less
+    always within [min_workers, max_workers] and [min_queue, max_queue]. Every decision is printed.
+    """
+
+    def __init__(self, min_workers=2, max_workers=None, min_queue=4, max_queue=64, memory_limit=None,
+                 interval=20, starve_ratio=0.10, idle_ratio=0.02):
+        self.min_workers = min_workers
+        self.max_workers = max_workers or multiprocessing.cpu_count()
+        self.min_queue = min_queue
+        self.max_queue = max_queue
+        self.memory_limit = memory_limit
+        self.interval = interval
+        self.starve_ratio = starve_ratio
+        self.idle_ratio = idle_ratio
+        self._steps = 0
+
+    def initial(self, workers, queue_size):
+        'Clips the requested workers and queue depth to the bounds'
+        workers = int(np.clip(workers, self.min_workers, self.max_workers))
+        queue_size = int(np.clip(queue_size, self.min_queue, self.max_queue))
+        return workers, queue_size
+
+    def log(self, enqueuer, message):
+        print('loader autoscale: %s -> %d workers, queue %d, %.1f MB' % (
+            message, enqueuer.n_workers, enqueuer.queue_size, enqueuer.memory() / 2. ** 20))
+
+    def on_start(self, enqueuer):
+        if enqueuer.ring.n_slots < self.max_queue:
+            self.log(enqueuer, 'queue capacity clipped to %d slots of %.1f MB by the memory limit' % (
+                enqueuer.ring.n_slots, enqueuer.ring.slot_nbytes / 2. ** 20))
+        if self.memory_limit is not None and enqueuer.memory() > self.memory_limit:
+            self.log(enqueuer, 'over memory limit at start')
+
+    def on_step(self, enqueuer, step_stats):
+        self._steps += 1
+        if self._steps % self.interval:
+            return
+        data, compute, depth = step_stats.window(self.interval)
+        busy = data.sum() + compute.sum()
+        wait_ratio = data.sum() / busy if busy > 0 else 0.
+        # unknown depth (-1) reads as an empty queue
+        fill = np.maximum(depth, 0).mean() / enqueuer.queue_size
+        if wait_ratio > self.starve_ratio and fill < 0.25:
+            self.grow(enqueuer, 'trainer waiting %.0f%% on data' % (100 * wait_ratio))
+        elif wait_ratio < self.idle_ratio and fill > 0.75:
+            self.shrink(enqueuer, 'queue %.0f%% full' % (100 * fill))
+
+    def grow(self, enqueuer, reason):
+        if enqueuer.n_workers >= self.max_workers and enqueuer.queue_size >= min(self.max_queue, enqueuer.ring.n_slots):
+            return
+        if self.memory_limit is not None:
+            # a new worker costs about as much as the average current one, plus the two new slots
+            memory = enqueuer.memory()
+            per_worker = (memory - enqueuer.slots_memory()) / max(enqueuer.n_workers, 1)
+            if memory + per_worker + 2 * enqueuer.ring.slot_nbytes > self.memory_limit:
+                self.log(enqueuer, '%s, memory limit reached' % reason)
+                return
+        if enqueuer.n_workers < self.max_workers:
+            enqueuer.add_worker()
+        enqueuer.set_queue_size(min(enqueuer.queue_size + 2, self.max_queue))
+        self.log(enqueuer, reason)
+
+    def shrink(self, enqueuer, reason):
+        if enqueuer.n_workers <= self.min_workers and enqueuer.queue_size <= self.min_queue:
+            return
+        if enqueuer.n_workers > self.min_workers:
+            enqueuer.remove_worker()
+        enqueuer.set_queue_size(max(enqueuer.queue_size - 1, self.min_queue))
+        self.log(enqueuer, reason)
@@ -1,5 +1,7 @@
+import sys
 import warnings
 import copy
+import time
 import numpy as np
 from scipy.sparse import issparse
 
@@ -9,12 +11,27 @@ from keras.utils.data_utils import GeneratorEnqueuer
 from keras.utils.data_utils import OrderedEnqueuer
 from keras.utils.generic_utils import Progbar
 from keras import callbacks as cbks
+from utils.shared_batches import SharedMemoryEnqueuer
+from utils.step_stats import StepStats, batch_nbytes, queue_depth
+from utils.async_validation import AsyncValidator
 
 def custom_fit_generator(model, generator, steps_per_epoch=None, epochs=1, verbose=1, callbacks=None, validation_data=None,
                          validation_steps=None, class_weight=None, max_queue_size=10, workers=1, use_multiprocessing=False,
-                         shuffle=True, initial_epoch=0):
+                         shuffle=True, initial_epoch=0, shared_memory=False, step_stats=None, autoscaler=None,
+                         async_validation=False, validation_device=''):
         """
-        Same function fit_generator as Keras but with only a subset of the variables displayed
+        Same function fit_generator as Keras but with only a subset of the variables displayed.
+        shared_memory: with a Sequence and use_multiprocessing, workers write batches into a ring of
+        max_queue_size shared-memory slots and only slot indices go through the queue
+        step_stats: StepStats collecting per-step data-wait time, compute time, queue depth and batch bytes
+        (a new one without trace when None). Steps are added to the batch logs, the per-epoch summary
+        (p50/p95, data_wait_ratio, patches_per_sec) to the epoch logs, and the object is kept as model.step_stats
+        autoscaler: LoaderAutoscaler resizing the shared-memory enqueuer workers and queue from the step stats;
+        workers and max_queue_size are then the starting point (ignored with other enqueuers)
+        async_validation: with in-memory validation data, validate weight snapshots in a separate process while
+        the next epoch trains; the val_ logs of an epoch reach the callbacks at the end of the following epoch
+        (none at the first), and the last epoch is added to the history after training
+        validation_device: CUDA_VISIBLE_DEVICES of the async validation process ('' for CPU)
         """
         wait_time = 0.01  # in seconds
         epoch = initial_epoch
@@ -85,6 +102,10 @@ def custom_fit_generator(model, generator, steps_per_epoch=None, epochs=1, verbo
 
         enqueuer = None
         val_enqueuer = None
+        validator = None
+        if step_stats is None:
+            step_stats = StepStats()
+        model.step_stats = step_stats
 
         try:
             if do_validation and not val_gen:
@@ -106,9 +127,18 @@ def custom_fit_generator(model, generator, steps_per_epoch=None, epochs=1, verbo
                     val_data += [0.]
                 for cbk in callbacks:
                     cbk.validation_data = val_data
+                if async_validation and val_sample_weight is not None:
+                    raise ValueError('`async_validation` does not support validation sample weights.')
 
             if workers > 0:
-                if is_sequence:
+                if is_sequence and use_multiprocessing and shared_memory:
+                    enqueuer = SharedMemoryEnqueuer(generator, shuffle=shuffle)
+                    if autoscaler is not None:
+                        workers, max_queue_size = autoscaler.initial(workers, max_queue_size)
+                        enqueuer.start(workers=workers, max_queue_size=max_queue_size,
+                                       queue_capacity=autoscaler.max_queue, memory_limit=autoscaler.memory_limit)
+                        autoscaler.on_start(enqueuer)
+                elif is_sequence:
                     enqueuer = OrderedEnqueuer(generator,
                                                use_multiprocessing=use_multiprocessing,
                                                shuffle=shuffle)
@@ -116,7 +146,11 @@ def custom_fit_generator(model, generator, steps_per_epoch=None, epochs=1, verbo
                     enqueuer = GeneratorEnqueuer(generator,
                                                  use_multiprocessing=use_multiprocessing,
                                                  wait_time=wait_time)
-                enqueuer.start(workers=workers, max_queue_size=max_queue_size)
+                if autoscaler is not None and not isinstance(enqueuer, SharedMemoryEnqueuer):
+                    warnings.warn('Loader autoscaling needs the shared-memory enqueuer, keeping %d workers' % workers)
+                    autoscaler = None
+                if not enqueuer.is_running():
+                    enqueuer.start(workers=workers, max_queue_size=max_queue_size)
                 output_generator = enqueuer.get()
             else:
                 if is_sequence:
@@ -129,10 +163,13 @@ def custom_fit_generator(model, generator, steps_per_epoch=None, epochs=1, verbo
             epoch_logs = {}
             while epoch < epochs:
                 callbacks.on_epoch_begin(epoch)
+                step_stats.reset()
                 steps_done = 0
                 batch_index = 0
                 while steps_done < steps_per_epoch:
+                    step_start = time.time()
                     generator_output = next(output_generator)
+                    data_time = time.time() - step_start
 
                     if not hasattr(generator_output, '__len__'):
                         raise ValueError('Output of generator should be '
@@ -162,9 +199,18 @@ def custom_fit_generator(model, generator, steps_per_epoch=None, epochs=1, verbo
                     batch_logs['size'] = batch_size
                     callbacks.on_batch_begin(batch_index, batch_logs)
 
+                    compute_start = time.time()
                     outs = model.train_on_batch(x, y,
                                                sample_weight=sample_weight,
                                                class_weight=class_weight)
+                    step_stats.record(epoch, batch_index, data_time=data_time,
+                                      compute_time=time.time() - compute_start,
+                                      queue_depth=queue_depth(enqueuer),
+                                      batch_bytes=batch_nbytes(x, y, sample_weight),
+                                      batch_size=batch_size)
+                    batch_logs.update(step_stats.last)
+                    if autoscaler is not None:
+                        autoscaler.on_step(enqueuer, step_stats)
 
                     if not isinstance(outs, list):
                         outs = [outs]
@@ -185,6 +231,12 @@ def custom_fit_generator(model, generator, steps_per_epoch=None, epochs=1, verbo
                                 workers=workers,
                                 use_multiprocessing=use_multiprocessing,
                                 max_queue_size=max_queue_size)
+                        elif async_validation:
+                            if validator is None:
+                                validator = AsyncValidator(model, validation_data[0], validation_data[1],
+                                                           batch_size=batch_size, device=validation_device)
+                            validator.submit(epoch, model.get_weights())
+                            val_outs = validator.collect()[1] if validator.pending > 1 else []
                         else:
                             # No need for try/except because
                             # data has already been validated.
@@ -202,6 +254,15 @@ def custom_fit_generator(model, generator, steps_per_epoch=None, epochs=1, verbo
                     if callback_model.stop_training:
                         break
 
+                summary = step_stats.summary()
+                epoch_logs.update(summary)
+                step_stats.write_summary(epoch, summary)
+                if verbose and summary:
+                    print('data wait p50/p95 %.3fs/%.3fs, compute p50/p95 %.3fs/%.3fs, waiting on data %.0f%%, '
+                          'queue depth %.1f, %.1f patches/sec' % (
+                              summary['data_time_p50'], summary['data_time_p95'], summary['compute_time_p50'],
+                              summary['compute_time_p95'], 100 * summary['data_wait_ratio'],
+                              summary['queue_depth_mean'], summary['patches_per_sec']))
                 callbacks.on_epoch_end(epoch, epoch_logs)
                 epoch += 1
                 if callback_model.stop_training:
@@ -214,6 +275,16 @@ def custom_fit_generator(model, generator, steps_per_epoch=None, epochs=1, verbo
             finally:
                 if val_enqueuer is not None:
                     val_enqueuer.stop()
+                step_stats.close()
+                if validator is not None and (validator.pending == 0 or sys.exc_info()[0] is not None):
+                    validator.close()
+
+        if validator is not None and validator.pending > 0:
+            # validation of the last epoch, never seen by the callbacks
+            _, val_outs = validator.collect()
+            validator.close()
+            for l, o in zip(out_labels, val_outs):
+                model.history.history.setdefault('val_' + l, []).append(o)
 
         callbacks.on_train_end()
         return model.history
\ No newline at end of file
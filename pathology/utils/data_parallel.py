@@ -0,0 +1,279 @@
+import copy
+import hashlib
+import json
+import multiprocessing
+import os
+import shutil
+import tempfile
+import traceback
+import numpy as np
+from keras.utils import Sequence
+from utils.shared_batches import SharedMemoryEnqueuer
+
+
+class SharedAllReduce(object):
+    """
+    Averages float32 vectors across the world local processes through one shared-memory row per process:
+    every process writes its row, averages its 1/world segment of the columns and reads back the whole result.
+    Two barriers per call, so a process can be one call ahead without overwriting anything still being read.
+    """
+
+    def __init__(self, world, size, context=multiprocessing):
+        self.world = world
+        self.size = size
+        self._rows = context.RawArray('f', world * size)
+        self._result = context.RawArray('f', size)
+        self._barrier = context.Barrier(world)
+
+    def wait(self):
+        self._barrier.wait()
+
+    def abort(self):
+        'Breaks the barrier, so the other processes fail instead of waiting forever'
+        self._barrier.abort()
+
+    def mean(self, rank, values):
+        n = len(values)
+        rows = np.frombuffer(self._rows, dtype=np.float32).reshape(self.world, self.size)
+        result = np.frombuffer(self._result, dtype=np.float32)
+        rows[rank, :n] = values
+        self.wait()
+        chunk = -(-n // self.world)
+        segment = slice(rank * chunk, min((rank + 1) * chunk, n))
+        result[segment] = rows[:, segment].mean(axis=0)
+        self.wait()
+        return result[:n].copy()
+
+    def broadcast(self, rank, values, root=0):
+        rows = np.frombuffer(self._rows, dtype=np.float32).reshape(self.world, self.size)
+        n = len(values)
+        if rank == root:
+            rows[root, :n] = values
+        self.wait()
+        out = rows[root, :n].copy()
+        self.wait()
+        return out
+
+
+class ShardedSequence(Sequence):
+    """
+    Batch index*world + rank of a Sequence: the world shards of a step together make one world-times-larger batch
+    """
+
+    def __init__(self, sequence, rank, world):
+        self.sequence = sequence
+        self.rank = rank
+        self.world = world
+
+    def __len__(self):
+        return len(self.sequence) // self.world
+
+    def __getitem__(self, index):
+        return self.sequence[index * self.world + self.rank]
+
+    def on_epoch_end(self):
+        self.sequence.on_epoch_end()
+
+
+def flatten(arrays):
+    return np.concatenate([np.ravel(a) for a in arrays]).astype(np.float32)
+
+
+def unflatten(values, like):
+    arrays, start = [], 0
+    for a in like:
+        size = int(np.prod(a.shape))
+        arrays.append(values[start:start + size].reshape(a.shape).astype(a.dtype))
+        start += size
+    return arrays
+
+
+class DataParallelStep(object):
+    """
+    One synchronous data-parallel training step of a compiled keras model: local gradients, averaged with
+    SharedAllReduce, applied by the optimizer of the model through gradient placeholders.
+    The forward pass runs the model updates (BatchNormalization moving averages), which therefore stay local
+    until sync_weights().
+    """
+
+    # Keras 2.1 training internals used to build the step, checked so that another Keras fails clearly
+    KERAS_INTERNALS = ('_feed_inputs', '_feed_targets', '_feed_sample_weights', '_standardize_user_data',
+                       'metrics_tensors', 'total_loss')
+
+    def __init__(self, model, rank, allreduce):
+        import keras
+        from keras import backend as K
+        missing = [name for name in self.KERAS_INTERNALS if not hasattr(model, name)]
+        if missing:
+            raise RuntimeError('DataParallelStep needs a model compiled by Keras 2.1, Keras %s has no %s'
+                               % (keras.__version__, ', '.join(missing)))
+        self.model = model
+        self.rank = rank
+        self.allreduce = allreduce
+        params = getattr(model, '_collected_trainable_weights', model.trainable_weights)
+        self.inputs = model._feed_inputs + model._feed_targets + model._feed_sample_weights
+        self.learning_phase = model.uses_learning_phase and not isinstance(K.learning_phase(), int)
+        if self.learning_phase:
+            self.inputs += [K.learning_phase()]
+        self.n_outputs = 1 + len(model.metrics_tensors)
+        grads = K.gradients(model.total_loss, params)
+        self.grad_fn = K.function(self.inputs, [model.total_loss] + model.metrics_tensors + grads,
+                                  updates=model.updates)
+        placeholders = [K.placeholder(shape=K.int_shape(p)) for p in params]
+        # the optimizer applies the averaged gradients fed to the placeholders: get_gradients is only
+        # swapped while building its updates, so the model still trains normally with fit afterwards
+        optimizer = model.optimizer
+        get_gradients = optimizer.get_gradients
+        optimizer.get_gradients = lambda loss, params: placeholders
+        try:
+            updates = optimizer.get_updates(loss=model.total_loss, params=params)
+        finally:
+            optimizer.get_gradients = get_gradients
+        self.apply_fn = K.function(placeholders, [], updates=updates)
+        self.params = params
+
+    def ins(self, x, y):
+        x, y, sample_weights = self.model._standardize_user_data(x, y)
+        return x + y + sample_weights
+
+    def __call__(self, x, y):
+        'Trains on the local shard of a step, returns the loss and metrics averaged over all shards'
+        outs = self.grad_fn(self.ins(x, y) + ([1.] if self.learning_phase else []))
+        values = np.concatenate([flatten(outs[self.n_outputs:]), np.array(outs[:self.n_outputs], dtype=np.float32)])
+        values = self.allreduce.mean(self.rank, values)
+        grads = unflatten(values[:-self.n_outputs], outs[self.n_outputs:])
+        self.apply_fn(grads)
+        return values[-self.n_outputs:]
+
+    def evaluate(self, batches):
+        'Loss and metrics over the union of the local validation batches of all processes'
+        totals, n = np.zeros(self.n_outputs), 0
+        for x, y in batches:
+            outs = self.model.test_on_batch(x, y)
+            totals += np.array(outs if isinstance(outs, list) else [outs]) * len(x)
+            n += len(x)
+        values = self.allreduce.mean(self.rank, np.append(totals, n).astype(np.float32))
+        return values[:-1] / max(values[-1], 1)
+
+    def broadcast_weights(self, root=0):
+        weights = self.model.get_weights()
+        self.model.set_weights(unflatten(self.allreduce.broadcast(self.rank, flatten(weights), root), weights))
+
+    def sync_weights(self):
+        'Averages all weights, which only differ in their BatchNormalization statistics'
+        weights = self.model.get_weights()
+        self.model.set_weights(unflatten(self.allreduce.mean(self.rank, flatten(weights)), weights))
+
+
+def partition_digest(partition):
+    'Digest of the (ids, labels) partition of a Dataset, to check that every process trains on the same split'
+    ids, labels = partition
+    text = json.dumps(dict((phase, [[str(i) for i in ids[phase]], [str(l) for l in labels[phase]]]) for phase in ids),
+                      sort_keys=True)
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def validation_batches(data, rank, world, batch_size):
+    'Shard rank of the validation data, a Sequence or (X, y) arrays'
+    if isinstance(data, Sequence):
+        for index in range(rank, len(data), world):
+            yield data[index]
+    else:
+        X, y = data
+        for start in range(rank * batch_size, len(X), world * batch_size):
+            yield X[start:start + batch_size], y[start:start + batch_size]
+
+
+def _train_worker(rank, world, config, lr, epochs, threads, allreduce, stop_flag, directory, partition, digest):
+    try:
+        os.environ['CUDA_VISIBLE_DEVICES'] = ''
+        import tensorflow as tf
+        from keras import backend as K
+        from keras.optimizers import Adam
+        K.set_session(tf.Session(config=tf.ConfigProto(intra_op_parallelism_threads=threads,
+                                                       inter_op_parallelism_threads=2)))
+        from models import Model
+        # streamed splits: a replica only decodes its 1/world shard of the validation patients, and no test patient
+        config = copy.copy(config)
+        config.lazy_splits = True
+        config.async_validation = False
+        replica = Model(config, partition)
+        # ranks on different splits would silently average gradients of different data
+        if partition_digest(replica.dataset._partition) != digest:
+            raise RuntimeError('Rank %d does not train on the partition of the parent process' % rank)
+        replica.set_trainable()
+        model = replica.model
+        optimizer = Adam(lr=lr, beta_1=0.9, beta_2=0.999, epsilon=1e-08, decay=config.lr_decay)
+        model.compile(optimizer=optimizer, loss='binary_crossentropy', metrics=['accuracy'])
+        step = DataParallelStep(model, rank, allreduce)
+        # the dense head is randomly initialised by every replica: start from those of rank 0
+        step.broadcast_weights()
+
+        sequence = ShardedSequence(replica.train_generator, rank, world)
+        enqueuer = SharedMemoryEnqueuer(sequence, shuffle=False)
+        enqueuer.start(workers=config.parallel_loader_workers, max_queue_size=config.parallel_loader_workers + 2)
+        batches = enqueuer.get()
+        validation_data = replica.get_validation_data()
+        history = {}
+        best, wait = np.inf, 0
+        try:
+            for epoch in range(epochs):
+                outs = np.array([step(x, y) for x, y in (next(batches) for _ in range(len(sequence)))])
+                step.sync_weights()
+                val_outs = step.evaluate(validation_batches(validation_data, rank, world, config.batch_size))
+                logs = dict(zip(model.metrics_names, outs.mean(axis=0)))
+                logs.update(('val_' + k, v) for k, v in zip(model.metrics_names, val_outs))
+                for k, v in logs.items():
+                    history.setdefault(k, []).append(float(v))
+                if rank == 0:
+                    print('epoch %d/%d - %s' % (epoch + 1, epochs, ' - '.join('%s: %.4f' % kv for kv in sorted(logs.items()))))
+                    # same rule as EarlyStopping(monitor='val_loss', min_delta=0, patience=5)
+                    if logs['val_loss'] < best:
+                        best, wait = logs['val_loss'], 0
+                    else:
+                        wait += 1
+                        stop_flag.value = int(wait >= 5)
+                allreduce.wait()
+                if stop_flag.value:
+                    break
+        finally:
+            enqueuer.stop()
+        if rank == 0:
+            model.save_weights(os.path.join(directory, 'weights.h5'))
+            with open(os.path.join(directory, 'history.json'), 'w') as f:
+                json.dump(history, f)
+    except Exception:
+        traceback.print_exc()
+        allreduce.abort()
+        raise
+
+
+def train_data_parallel(config, lr, epochs, world, n_weights, partition, threads=None):
+    """
+    Trains config.parallel_workers CPU replicas of Model on shards of each training batch, with gradients
+    averaged every step: same updates as one process with world-times-larger batches.
+    n_weights is the number of scalars in all the weights of the model, the largest vector ever averaged.
+    partition is the (ids, labels) partition of the dataset of the caller, used by every replica instead of
+    its own random split; a replica whose dataset ends up with another one fails.
+    Returns the directory holding the final weights.h5 and history.json, to be removed by the caller.
+    """
+    threads = threads or max(1, multiprocessing.cpu_count() // world)
+    directory = tempfile.mkdtemp(prefix='data_parallel_')
+    # spawn: every replica builds its own TensorFlow graph and session
+    context = multiprocessing.get_context('spawn')
+    # room for the loss and metrics appended to the gradients
+    allreduce = SharedAllReduce(world, n_weights + 16, context)
+    stop_flag = context.RawValue('i', 0)
+    processes = [context.Process(target=_train_worker,
+                                 args=(rank, world, config, lr, epochs, threads, allreduce, stop_flag, directory,
+                                       partition, partition_digest(partition)))
+                 for rank in range(world)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    failed = [rank for rank, process in enumerate(processes) if process.exitcode != 0]
+    if failed:
+        shutil.rmtree(directory, ignore_errors=True)
+        raise RuntimeError('Data-parallel training failed on ranks %s' % failed)
+    return directory
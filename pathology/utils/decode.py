@@ -0,0 +1,39 @@
+import os
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+
+
+_executor = None
+_executor_pid = None
+
+def get_executor(workers):
+    'One decode thread pool per process: threads do not survive a fork'
+    global _executor, _executor_pid
+    if _executor is None or _executor_pid != os.getpid():
+        _executor = ThreadPoolExecutor(max_workers=workers)
+        _executor_pid = os.getpid()
+    return _executor
+
+def decode_patch(path, out, shape):
+    img = Image.open(path)
+    # DCT-domain downscaling: a 448px JPEG is decoded directly at 224px
+    img.draft('RGB', (shape, shape))
+    if img.mode != 'RGB':
+        img = img.convert('RGB')
+    if img.size != (shape, shape):
+        img = img.resize((shape, shape))
+    out[...] = np.asarray(img)
+
+def decode_patches(paths, out, workers=8):
+    """
+    Decodes the JPEG patches in paths into the preallocated uint8 (len(paths), shape, shape, 3) buffer out
+    """
+    shape = out.shape[1]
+    if workers <= 1:
+        for path, patch in zip(paths, out):
+            decode_patch(path, patch, shape)
+        return out
+    # list() re-raises decoding errors from the worker threads
+    list(get_executor(workers).map(decode_patch, paths, out, [shape] * len(paths)))
+    return out
@@ -0,0 +1,67 @@
+import hashlib
+import os
+import numpy as np
+
+
+def weights_hash(model):
+    'Short digest of the weights of a keras model, to key cached embeddings to the backbone that produced them'
+    sha = hashlib.sha1()
+    for weights in model.get_weights():
+        sha.update(np.ascontiguousarray(weights).tobytes())
+    return sha.hexdigest()[:16]
+
+
+class EmbeddingStore(object):
+    """
+    float16 memory-mapped (N, dim) pooled backbone embeddings, row i holding manifest patch i:
+        embeddings.npy : the embeddings
+        done.npy       : (N,) whether row i has been computed, so an interrupted build resumes
+    One store per backbone weights hash and manifest (root and Manifest.digest), so rows always match
+    the patches of the manifest; files of another shape are rebuilt.
+    """
+
+    def __init__(self, directory, n_patches, dim):
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        embeddings_path = os.path.join(directory, "embeddings.npy")
+        done_path = os.path.join(directory, "done.npy")
+        self.embeddings = self.done = None
+        if os.path.isfile(embeddings_path) and os.path.isfile(done_path):
+            self.embeddings = np.lib.format.open_memmap(embeddings_path, mode='r+')
+            self.done = np.lib.format.open_memmap(done_path, mode='r+')
+            if self.embeddings.shape != (n_patches, dim) or self.done.shape != (n_patches,):
+                print("%s: embeddings of shape %s instead of %s, rebuilding" % (directory, self.embeddings.shape, (n_patches, dim)))
+                self.embeddings = self.done = None
+        if self.embeddings is None:
+            self.embeddings = np.lib.format.open_memmap(embeddings_path, mode='w+', dtype=np.float16,
+                                                        shape=(n_patches, dim))
+            self.done = np.lib.format.open_memmap(done_path, mode='w+', dtype=bool, shape=(n_patches,))
+
+    def write(self, indexes, embeddings):
+        self.embeddings[indexes] = embeddings.astype(np.float16)
+        self.done[indexes] = True
+
+    def read(self, indexes):
+        return self.embeddings[np.asarray(indexes).ravel()].astype(np.float32)
+
+    def flush(self):
+        self.embeddings.flush()
+        self.done.flush()
+
+
+def build_embeddings(store, dataset, root, patch_store, embedding_model, batch_size=100):
+    """
+    Computes the embeddings of every manifest patch that is not in the store yet
+    """
+    manifest = dataset.get_manifest(root)
+    for p, patient in enumerate(manifest.patients):
+        start, end = manifest.offsets[p], manifest.offsets[p + 1]
+        if store.done[start:end].all():
+            continue
+        print ("%s: embedding %d patches"% (patient, end - start))
+        for chunk in range(start, end, batch_size):
+            indexes = np.arange(chunk, min(chunk + batch_size, end))[np.newaxis]
+            X = dataset.load_manifest_patches(root, [patient], indexes, store = patch_store)
+            store.write(indexes[0], embedding_model.predict(X))
+        store.flush()
@@ -1,44 +1,167 @@
+import hashlib
+import os
+import zlib
 import numpy as np
+from numpy.lib.format import open_memmap
 from PIL import Image
+from keras.utils import Sequence
 
 
-class Generator(object):
-    
-    def __init__(self, config, dataset):
-        
+class PatchSequence(Sequence):
+    """
+    keras Sequence over the training patients, safe with OrderedEnqueuer and use_multiprocessing:
+    the patient order of an epoch and the patches sampled for a batch only depend on (seed, epoch, index),
+    so every worker process produces distinct batches and no work is duplicated
+    """
+
+    def __init__(self, config, dataset, seed=0):
+
         self.config = config
         self.dataset = dataset
         self.list_IDs = self.dataset._partition[0]['train']
         self.list_labels = self.dataset._partition[1]['train']
-    
-    def generate(self):
-        'Generates batches of samples'
-        
-        while 1:
-            indexes = self.__get_exploration_order()
-            imax = int(len(indexes)/self.config.batch_size)
-            for i in range(imax):
-                list_IDs_temp = [self.list_IDs[k] for k in indexes[i*self.config.batch_size:(i+1)*self.config.batch_size]]
-                list_labels_temp = [self.list_labels[k] for k in indexes[i*self.config.batch_size:(i+1)*self.config.batch_size]]
-
-                X, y = self.__data_generation(list_IDs_temp,list_labels_temp)
-
-                yield X, y
-
-    def __get_exploration_order(self):
-        'Generates order of exploration'
-        indexes = np.arange(len(self.list_IDs))
-        np.random.shuffle(indexes)
-        return indexes
-
-    def __data_generation(self, list_IDs_temp, list_labels_temp):
-        
-        X, y = self.dataset.convert_to_arrays(list_IDs_temp, list_labels_temp, size = self.config.sampling_size_train)
-        
+        self.seed = seed
+        self.epoch = 0
+
+    def __len__(self):
+        return int(len(self.list_IDs)/self.config.batch_size)
+
+    def __getitem__(self, index):
+        indexes = self.get_exploration_order()[index*self.config.batch_size:(index+1)*self.config.batch_size]
+        list_IDs_temp = [self.list_IDs[k] for k in indexes]
+        list_labels_temp = [self.list_labels[k] for k in indexes]
+
+        # the datasets sample patches with the global numpy RNG: seed it for this batch, then give the caller
+        # (a loader worker, or the trainer itself) its state back
+        state = np.random.get_state()
+        np.random.seed([self.seed, self.epoch, index])
+        try:
+            X, y = self.dataset.convert_to_arrays(list_IDs_temp, list_labels_temp, size = self.config.sampling_size_train)
+        finally:
+            np.random.set_state(state)
+
+        return X, y
+
+    def get_exploration_order(self):
+        'Order of exploration of the current epoch'
+        return np.random.RandomState([self.seed, self.epoch]).permutation(len(self.list_IDs))
+
+    def on_epoch_end(self):
+        self.epoch += 1
+
+
+class EmbeddingSequence(Sequence):
+    """
+    Same batches as PatchSequence, but of cached backbone embeddings instead of pixels
+    """
+
+    def __init__(self, config, manifest, store, list_IDs, list_labels, seed=0):
+
+        self.config = config
+        self.manifest = manifest
+        self.store = store
+        self.list_IDs = list_IDs
+        self.list_labels = list_labels
+        self.seed = seed
+        self.epoch = 0
+
+    def __len__(self):
+        return int(len(self.list_IDs)/self.config.batch_size)
+
+    def __getitem__(self, index):
+        indexes = self.get_exploration_order()[index*self.config.batch_size:(index+1)*self.config.batch_size]
+        list_IDs_temp = [self.list_IDs[k] for k in indexes]
+        list_labels_temp = [self.list_labels[k] for k in indexes]
+
+        random_state = np.random.RandomState([self.seed, self.epoch, index])
+        patches = self.manifest.sample(list_IDs_temp, self.config.sampling_size_train, random_state=random_state)
+        X = self.store.read(patches)
+        y = np.repeat(list_labels_temp, self.config.sampling_size_train)
+
+        return X, y
+
+    def get_exploration_order(self):
+        return np.random.RandomState([self.seed, self.epoch]).permutation(len(self.list_IDs))
+
+    def on_epoch_end(self):
+        self.epoch += 1
+
+
+class SplitSequence(Sequence):
+    """
+    The validation or test patients of a dataset, size patches each, materialised patients_per_batch at a time.
+    The patches of a patient are drawn with a seed derived from (seed, patient id), so every epoch and every run
+    sees the same ones; with cache_dir they are also saved there on first use and memory-mapped afterwards.
+    """
+
+    def __init__(self, config, dataset, phase, size, seed=0, cache_dir=None, patients_per_batch=1):
+
+        self.config = config
+        self.dataset = dataset
+        self.phase = phase
+        self.size = size
+        self.seed = seed
+        self.list_IDs = self.dataset._partition[0][phase]
+        self.list_labels = self.dataset._partition[1][phase]
+        self.patients_per_batch = patients_per_batch
+        self.cache_dir = None
+        if cache_dir is not None:
+            # patches of another decoding backend differ: each one gets its own directory
+            self.cache_dir = os.path.join(cache_dir, "%s_seed%d_%dx%d_%s_%s_fast%d_manifest%d" % (
+                phase, seed, size, config.input_shape, config.dataset, config.patch_format,
+                config.fast_decode, config.use_manifest))
+            if not os.path.isdir(self.cache_dir):
+                os.makedirs(self.cache_dir)
+
+    @property
+    def y(self):
+        'Patch labels of the whole split, without loading any patch'
+        return np.repeat(self.list_labels, self.size)
+
+    def __len__(self):
+        return int(np.ceil(len(self.list_IDs) / float(self.patients_per_batch)))
+
+    def __getitem__(self, index):
+        k = slice(index*self.patients_per_batch, (index+1)*self.patients_per_batch)
+        X = np.concatenate([self.load(sample, label) for sample, label in zip(self.list_IDs[k], self.list_labels[k])])
+        y = np.repeat(self.list_labels[k], self.size)
         return X, y
-    
-    
-  
-    
-    
-    
\ No newline at end of file
+
+    def load(self, sample, label):
+        if self.cache_dir is not None:
+            path = os.path.join(self.cache_dir, "%s.npy" % sample)
+            if os.path.exists(path):
+                return np.load(path, mmap_mode='r')
+        # the datasets sample with the global RNG: seed it for this patient, then give the caller its state back
+        state = np.random.get_state()
+        np.random.seed([self.seed, zlib.crc32(str(sample).encode())])
+        try:
+            X, _ = self.dataset.convert_to_arrays([sample], [label], phase = self.phase, size = self.size)
+        finally:
+            np.random.set_state(state)
+        if self.cache_dir is not None:
+            # written under a temporary name, so concurrent readers never see a partial file
+            tmp_path = "%s.%d.tmp.npy" % (path[:-4], os.getpid())
+            np.save(tmp_path, X)
+            os.replace(tmp_path, path)
+        return X
+
+    def arrays(self):
+        """
+        (X, y) of the whole split, X being a memory-map of <cache_dir>/X_<patients digest>.npy filled patient by patient
+        (needs cache_dir); the digest keeps runs with another random split from reusing it
+        """
+        if self.cache_dir is None:
+            raise ValueError("SplitSequence.arrays() needs a cache_dir")
+        digest = hashlib.sha1("\n".join(str(sample) for sample in self.list_IDs).encode('utf-8')).hexdigest()[:16]
+        path = os.path.join(self.cache_dir, "X_%s.npy" % digest)
+        if not os.path.exists(path):
+            first = self.load(self.list_IDs[0], self.list_labels[0])
+            tmp_path = "%s.%d.tmp.npy" % (path[:-4], os.getpid())
+            X = open_memmap(tmp_path, mode='w+', dtype=first.dtype, shape=(len(self.list_IDs)*self.size,) + first.shape[1:])
+            for i, (sample, label) in enumerate(zip(self.list_IDs, self.list_labels)):
+                X[i*self.size:(i+1)*self.size] = self.load(sample, label)
+            X.flush()
+            del X
+            os.replace(tmp_path, path)
+        return np.load(path, mmap_mode='r'), self.y
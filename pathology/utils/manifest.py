@@ -0,0 +1,143 @@
+import hashlib
+import os
+import numpy as np
+from utils.patch_store import PatchStore
+
+
+def manifest_path(root):
+    return root.rstrip("/") + ".manifest.npz"
+
+
+class Manifest(object):
+    """
+    Compact binary index of a patch root, built once with build_manifest:
+        patients : (P,) patient ids, sorted
+        labels   : (P,) encoded labels (-1 when unknown), classes holds the label names
+        offsets  : (P + 1,) patches of patients[p] are offsets[p] ... offsets[p + 1] - 1
+        names    : (N,) patch file names (empty for packed stores and slides)
+        coords   : (N, 2) level 0 (x, y) of each patch (-1 when unknown)
+        scores   : (N,) tissue scores (nan when unknown)
+    Everything is held in memory: sampling needs no directory listing or spreadsheet parsing.
+    """
+
+    def __init__(self, path):
+        with np.load(path) as index:
+            self.patients = index['patients']
+            self.labels = index['labels']
+            self.classes = index['classes']
+            self.offsets = index['offsets']
+            self.names = index['names']
+            self.coords = index['coords']
+            self.scores = index['scores']
+        self._rows = dict((patient, i) for i, patient in enumerate(self.patients))
+
+    def digest(self):
+        'Short digest of the patch identities (patients, offsets, names, coords), to key data derived per patch row'
+        sha = hashlib.sha1()
+        for array in (self.patients, self.offsets, self.names, self.coords):
+            array = np.ascontiguousarray(array)
+            sha.update(("%s %s" % (array.dtype.str, array.shape)).encode())
+            sha.update(array.tobytes())
+        return sha.hexdigest()[:16]
+
+    def __contains__(self, patient):
+        return patient in self._rows
+
+    def rows(self, patients):
+        return np.array([self._rows[patient] for patient in patients], dtype=np.int64)
+
+    def counts(self, patients):
+        rows = self.rows(patients)
+        return self.offsets[rows + 1] - self.offsets[rows]
+
+    def sample(self, patients, size, random_state=None):
+        """
+        (len(patients), size) global patch indexes drawn with replacement within each patient,
+        with random_state (a np.random.RandomState) or the global RNG; raises ValueError for a patient without patches
+        """
+        rng = np.random if random_state is None else random_state
+        rows = self.rows(patients)
+        starts, counts = self.offsets[rows], self.offsets[rows + 1] - self.offsets[rows]
+        if np.any(counts == 0):
+            empty = [patient for patient, count in zip(patients, counts) if count == 0]
+            raise ValueError("No patches to sample for patient %s"% empty[0])
+        return starts[:, None] + (rng.random_sample((len(rows), size)) * counts[:, None]).astype(np.int64)
+
+    def local(self, patients, indexes):
+        'Position of global patch indexes within their patient'
+        return indexes - self.offsets[self.rows(patients)][:, None]
+
+    def paths(self, root, patients, indexes):
+        return ["%s/%s/%s"% (root, patient, name.decode('utf-8'))
+                for patient, row in zip(patients, indexes) for name in self.names[row]]
+
+
+def list_patches(root, patient, layout):
+    """
+    Names, coordinates and tissue scores of the patches of one patient
+    """
+    if layout == 'jpeg':
+        names = sorted(os.listdir("%s/%s"% (root, patient)), key=lambda name: (len(name), name))
+        return names, np.full((len(names), 2), -1, dtype=np.int64), np.full(len(names), np.nan, dtype=np.float32)
+    if layout == 'packed':
+        store = PatchStore(root)
+        coords, scores = store.index(patient)
+        return [''] * len(coords), coords, scores
+    if layout == 'svs':
+        coords = np.load("%s/%s.npy"% (root, patient))
+        return [''] * len(coords), coords, np.full(len(coords), np.nan, dtype=np.float32)
+    raise ValueError("Unknown layout %s"% layout)
+
+def build_manifest(root, labels, layout='jpeg', path=None):
+    """
+    labels: pandas Series of label names indexed by patient id, encoded in sorted order like LabelEncoder
+            (missing labels are encoded -1).
+    layout: 'jpeg' (one directory of tiles per patient), 'packed' (PatchStore) or 'svs' (coordinate index)
+    """
+    if layout == 'svs':
+        available = [name[:-4] for name in os.listdir(root) if name.endswith(".npy")]
+    else:
+        available = os.listdir(root)
+    labels = labels[labels.index.isin(available)]
+    patients = np.array(sorted(labels.index.astype(str)))
+    values = labels.loc[patients]
+    known = values.notnull().values
+    classes, known_labels = np.unique(np.asarray(values[known].values, dtype=str), return_inverse=True)
+    encoded = np.full(len(patients), -1, dtype=np.int64)
+    encoded[known] = known_labels
+
+    offsets, names, coords, scores = [0], [], [], []
+    for patient in patients:
+        patch_names, patch_coords, patch_scores = list_patches(root, patient, layout)
+        names.extend(patch_names)
+        coords.append(patch_coords)
+        scores.append(patch_scores)
+        offsets.append(offsets[-1] + len(patch_names))
+        print ("%s: %d patches"% (patient, len(patch_names)))
+
+    path = path or manifest_path(root)
+    np.savez(path, patients=patients, labels=encoded, classes=classes,
+             offsets=np.asarray(offsets, dtype=np.int64), names=np.asarray(names, dtype=np.bytes_),
+             coords=np.concatenate(coords).reshape((-1, 2)) if coords else np.zeros((0, 2), dtype=np.int64),
+             scores=np.concatenate(scores) if scores else np.zeros(0, dtype=np.float32))
+    return path
+
+
+if __name__ == '__main__':
+    # run from pathology/: python -m utils.manifest
+    import pandas as pd
+    miccai = pd.read_table('MICCAI_labels.txt', index_col = 0, delim_whitespace = True, header = 0).iloc[:, 0]
+    miccai_test = pd.read_table('MICCAI_Test.txt', index_col = 0, delim_whitespace = True, header = 0)
+    miccai_test = pd.Series(np.nan, index=miccai_test.index)
+    tcga = pd.read_excel('TCGA-MICCAI-Patients.xlsx', index_col = 'Patient').iloc[:, 0]
+    roots = [("/labs/gevaertlab/data/MICCAI/patches_448", miccai, 'jpeg'),
+             ("/labs/gevaertlab/data/MICCAI/patches_448_test", miccai_test, 'jpeg'),
+             ("/labs/gevaertlab/data/cedoz/patches_448", tcga, 'jpeg'),
+             ("/labs/gevaertlab/data/MICCAI/packed_224", miccai, 'packed'),
+             ("/labs/gevaertlab/data/MICCAI/packed_224_test", miccai_test, 'packed'),
+             ("/labs/gevaertlab/data/cedoz/packed_224", tcga, 'packed'),
+             ("/labs/gevaertlab/data/MICCAI/coords_448", miccai, 'svs'),
+             ("/labs/gevaertlab/data/MICCAI/coords_448_test", miccai_test, 'svs')]
+    for root, labels, layout in roots:
+        if os.path.isdir(root):
+            print ("manifest written to %s"% build_manifest(root, labels, layout))
@@ -0,0 +1,67 @@
+import numpy as np
+from PIL import Image
+from utils.manifest import Manifest, manifest_path
+from utils.decode import decode_patches
+
+
+class PatchDatasetMixin(object):
+    """
+    Patch loading shared by the datasets: JPEG decoding, packed PatchStore sampling and manifest lookups.
+    Expects config, _manifests (dict), _train_val_dir, _test_dir, _train_val_store and _test_store.
+    """
+
+    def get_manifest(self, root):
+        if root not in self._manifests:
+            self._manifests[root] = Manifest(manifest_path(root))
+        return self._manifests[root]
+
+    def load_jpeg(self, ids, out = None):
+
+        shape = self.config.input_shape
+        if out is None:
+            out = np.empty((len(ids), shape, shape, 3), dtype=np.uint8)
+        if self.config.fast_decode:
+            return decode_patches(ids, out, workers=self.config.decode_workers)
+        for k, ID in enumerate(ids):
+            img = Image.open(ID)
+            img = img.resize((shape, shape))
+            out[k] = np.array(img)[:,:,:3]
+        return out
+
+    def convert_to_arrays_packed(self, store, samples, labels, size = 1):
+
+        shape = self.config.input_shape
+        X = np.empty((len(samples)*size, shape, shape, 3), dtype=np.uint8)
+        for i, sample in enumerate(samples):
+            store.sample(sample, size, out=X[i*size:(i+1)*size])
+        y = np.repeat(labels, size)
+        return X, y
+
+    def convert_to_arrays_manifest(self, root, samples, labels, size = 1, store = None):
+
+        indexes = self.get_manifest(root).sample(samples, size)
+        X = self.load_manifest_patches(root, samples, indexes, store = store)
+        y = np.repeat(labels, size)
+        return X, y
+
+    def load_manifest_patches(self, root, samples, indexes, store = None):
+        'Patches at the (len(samples), k) global manifest indexes, patient after patient'
+
+        manifest = self.get_manifest(root)
+        size = indexes.shape[1]
+        shape = self.config.input_shape
+        X = np.empty((len(samples)*size, shape, shape, 3), dtype=np.uint8)
+        if store is not None:
+            positions = manifest.local(samples, indexes)
+            for i, sample in enumerate(samples):
+                store.read(sample, positions[i], out=X[i*size:(i+1)*size])
+        else:
+            self.load_jpeg(manifest.paths(root, samples, indexes), out=X)
+        return X
+
+    def get_manifest_root(self, phase):
+        'Patch root holding the manifest of a phase, and its PatchStore (None for JPEG patches)'
+        if self.config.patch_format == 'packed':
+            store = self._test_store if phase == 'test' else self._train_val_store
+            return store.root, store
+        return (self._test_dir if phase == 'test' else self._train_val_dir), None
@@ -0,0 +1,97 @@
+import os
+import numpy as np
+
+
+class PatchStore(object):
+    """
+    Packed per-slide patch container. Each slide is a directory holding
+        tiles.u8   : the pre-resized uint8 (N, size, size, 3) tiles back to back
+        index.npz  : 'coords' (N, 2) level 0 (x, y) of each tile and 'scores' (N,) tissue scores
+    Tiles are read through a read-only memory map, by index, with no decoding or resizing.
+    """
+
+    def __init__(self, root, size=224):
+        self.root = root
+        self.size = size
+        self._tiles = {}
+
+    def tiles_path(self, sample):
+        return os.path.join(self.root, "%s" % sample, "tiles.u8")
+
+    def index_path(self, sample):
+        return os.path.join(self.root, "%s" % sample, "index.npz")
+
+    def exists(self, sample):
+        return os.path.isfile(self.index_path(sample))
+
+    def open(self, sample):
+        if sample not in self._tiles:
+            n_bytes = os.path.getsize(self.tiles_path(sample))
+            n_tiles = n_bytes // (self.size * self.size * 3)
+            self._tiles[sample] = np.memmap(self.tiles_path(sample), dtype=np.uint8, mode='r',
+                                            shape=(n_tiles, self.size, self.size, 3))
+        return self._tiles[sample]
+
+    def count(self, sample):
+        return len(self.open(sample))
+
+    def index(self, sample):
+        with np.load(self.index_path(sample)) as index:
+            return index['coords'], index['scores']
+
+    def read(self, sample, indexes, out=None):
+        tiles = self.open(sample)
+        if out is None:
+            return tiles[indexes]
+        out[...] = tiles[indexes]
+        return out
+
+    def sample(self, sample, size, out=None):
+        'Random tiles drawn with replacement, like np.random.choice over the patch files'
+        indexes = np.random.randint(self.count(sample), size=size)
+        return self.read(sample, indexes, out=out)
+
+
+class PatchStoreWriter(object):
+    """
+    Appends tiles of one slide to a PatchStore directory; close() writes the index.
+    Passing the coords and scores of tiles already written resumes an interrupted slide:
+    anything in tiles.u8 beyond them is truncated.
+    """
+
+    def __init__(self, directory, size=224, coords=None, scores=None):
+        self.directory = directory
+        self.size = size
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._coords = [tuple(c) for c in coords] if coords is not None else []
+        self._scores = list(scores) if scores is not None else []
+        path = os.path.join(directory, "tiles.u8")
+        if self._coords and os.path.isfile(path):
+            self._file = open(path, "r+b")
+            self._file.truncate(len(self._coords) * size * size * 3)
+            self._file.seek(0, os.SEEK_END)
+        else:
+            self._file = open(path, "wb")
+
+    def __len__(self):
+        return len(self._coords)
+
+    def add(self, patch, x, y, score=np.nan):
+        if not isinstance(patch, np.ndarray) and patch.size != (self.size, self.size):
+            patch = patch.resize((self.size, self.size))
+        array = np.ascontiguousarray(np.asarray(patch)[:, :, :3], dtype=np.uint8)
+        assert array.shape == (self.size, self.size, 3)
+        self._file.write(array.tobytes())
+        self._coords.append((x, y))
+        self._scores.append(score)
+
+    def flush(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def close(self):
+        self._file.close()
+        np.savez(os.path.join(self.directory, "index.npz"),
+                 coords=np.asarray(self._coords, dtype=np.int64).reshape((-1, 2)),
+                 scores=np.asarray(self._scores, dtype=np.float32))
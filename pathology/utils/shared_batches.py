@@ -0,0 +1,279 @@
+import ctypes
+import mmap
+import multiprocessing
+import os
+import queue
+import random
+import sys
+import threading
+import traceback
+import numpy as np
+from multiprocessing.sharedctypes import RawArray
+
+
+# MADV_REMOVE of <linux/mman.h>, for Pythons without mmap.madvise (before 3.8)
+_MADV_REMOVE = 9
+
+
+def madvise_remove(buf):
+    'Frees the pages of a shared mmap, which read back as zeros: mmap.madvise when there is one, else libc madvise'
+    if hasattr(buf, 'madvise') and hasattr(mmap, 'MADV_REMOVE'):
+        buf.madvise(mmap.MADV_REMOVE)
+    elif sys.platform.startswith('linux'):
+        libc = ctypes.CDLL(None, use_errno=True)
+        libc.madvise.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int]
+        view = ctypes.c_char.from_buffer(buf)
+        try:
+            if libc.madvise(ctypes.addressof(view), len(buf), _MADV_REMOVE) != 0:
+                raise OSError(ctypes.get_errno(), 'madvise(MADV_REMOVE) failed')
+        finally:
+            # the ctypes view pins the mmap, which could not be closed otherwise
+            del view
+
+
+class SharedBatchRing(object):
+    """
+    Shared-memory slots, each holding one (x, y) batch of at most the probe batch size.
+    Slots are anonymous shared mappings inherited by the (forked) worker processes, so only slot indices go
+    through queues. Their pages are only committed when first written and handed back by release(),
+    so slots out of circulation take no memory.
+    """
+
+    def __init__(self, n_slots, x, y):
+        self.n_slots = n_slots
+        self.x_shape, self.x_dtype = x.shape, x.dtype
+        self.y_shape, self.y_dtype = y.shape, y.dtype
+        self._x = [mmap.mmap(-1, max(x.nbytes, 1)) for _ in range(n_slots)]
+        self._y = [mmap.mmap(-1, max(y.nbytes, 1)) for _ in range(n_slots)]
+        self._lengths = RawArray('l', n_slots)
+
+    @property
+    def slot_nbytes(self):
+        return len(self._x[0]) + len(self._y[0])
+
+    @property
+    def nbytes(self):
+        return self.n_slots * self.slot_nbytes
+
+    def x(self, slot):
+        return np.frombuffer(self._x[slot], dtype=self.x_dtype, count=int(np.prod(self.x_shape))).reshape(self.x_shape)
+
+    def y(self, slot):
+        return np.frombuffer(self._y[slot], dtype=self.y_dtype, count=int(np.prod(self.y_shape))).reshape(self.y_shape)
+
+    def release(self, slot):
+        'Returns the memory of a slot taken out of circulation (Linux only, elsewhere it stays committed)'
+        for buf in (self._x[slot], self._y[slot]):
+            madvise_remove(buf)
+
+    def write(self, slot, x, y):
+        if len(x) > self.x_shape[0] or x.shape[1:] != self.x_shape[1:]:
+            raise ValueError('Batch of shape %s does not fit slots of shape %s' % (x.shape, self.x_shape))
+        self.x(slot)[:len(x)] = x
+        self.y(slot)[:len(y)] = y
+        self._lengths[slot] = len(x)
+
+    def read(self, slot):
+        'Views on the slot, valid until it is released'
+        n = self._lengths[slot]
+        return self.x(slot)[:n], self.y(slot)[:n]
+
+
+def process_private_memory(pid):
+    """
+    Memory of a process not shared with any other in bytes (Private_Clean + Private_Dirty of smaps_rollup):
+    the copy-on-write pages a forked worker still shares with the trainer and the shared-memory slots are not counted.
+    Falls back to the resident size of statm on kernels without smaps_rollup (before 4.14), 0 without /proc.
+    """
+    try:
+        with open('/proc/%d/smaps_rollup' % pid) as f:
+            return sum(int(line.split()[1]) * 1024 for line in f if line.startswith(('Private_Clean:', 'Private_Dirty:')))
+    except (IOError, OSError, ValueError):
+        pass
+    try:
+        with open('/proc/%d/statm' % pid) as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError):
+        return 0
+
+
+def _worker(sequence, ring, tasks, free_slots, results):
+    epoch = 0
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        task_epoch, index = task
+        slot = None
+        try:
+            while epoch < task_epoch:
+                sequence.on_epoch_end()
+                epoch += 1
+            x, y = sequence[index]
+            slot = free_slots.get()
+            ring.write(slot, x, y)
+            results.put((slot, index))
+            slot = None
+        except Exception:
+            # the slot of a failed write goes back to the ring
+            if slot is not None:
+                free_slots.put(slot)
+            results.put((None, traceback.format_exc()))
+
+
+class SharedMemoryEnqueuer(object):
+    """
+    Runs a keras Sequence on worker processes that write their batches into a SharedBatchRing
+    and pass only slot indices back; get() yields NumPy views on the slots instead of unpickled copies.
+    Batches come back in completion order. Same interface as the keras enqueuers.
+    Workers can be added or removed and the queue depth changed while running, up to the queue_capacity
+    slots reserved at start.
+    """
+
+    def __init__(self, sequence, shuffle=False):
+        self.sequence = sequence
+        self.shuffle = shuffle
+        self.ring = None
+        self.workers = []
+        self._stop_event = None
+
+    def start(self, workers=1, max_queue_size=10, queue_capacity=None, memory_limit=None):
+        """
+        Reserves max(max_queue_size, queue_capacity) slots, of which max_queue_size in circulation: only these
+        take memory. With a memory_limit in bytes, both are first clipped to the number of slots that fit in it
+        (at least one).
+        """
+        # one batch to size the slots
+        x, y = self.sequence[0]
+        n_slots = max(max_queue_size, queue_capacity or 0)
+        if memory_limit is not None:
+            n_slots = max(1, min(n_slots, int(memory_limit // max(x.nbytes + y.nbytes, 1))))
+            max_queue_size = min(max_queue_size, n_slots)
+        self.ring = SharedBatchRing(n_slots, x, y)
+        # fork: the workers inherit the slot mappings, which cannot be pickled
+        self._context = multiprocessing.get_context('fork')
+        self.tasks = self._context.Queue()
+        self.free_slots = self._context.Queue()
+        self.results = self._context.Queue()
+        for slot in range(max_queue_size):
+            self.free_slots.put(slot)
+        # slots out of circulation, and slots to take out of circulation when next released
+        self._spare = list(range(max_queue_size, self.ring.n_slots))
+        self._retire = 0
+        self.queue_size = max_queue_size
+        self._stop_event = threading.Event()
+        self._feeder = threading.Thread(target=self._feed)
+        self._feeder.daemon = True
+        # bounds the indices enqueued ahead of the consumer to the workers plus the queue depth
+        self._pending = threading.Semaphore(max_queue_size)
+        self._pending_debt = 0
+        self.n_workers = 0
+        for _ in range(workers):
+            self.add_worker()
+        self._feeder.start()
+
+    def add_worker(self):
+        self.workers = [w for w in self.workers if w.is_alive()]
+        worker = self._context.Process(target=_worker, args=(self.sequence, self.ring, self.tasks,
+                                                             self.free_slots, self.results))
+        worker.daemon = True
+        worker.start()
+        self.workers.append(worker)
+        self.n_workers += 1
+        self._add_permits(1)
+
+    def remove_worker(self):
+        'The first worker to pick the stop task exits after its current batch'
+        if self.n_workers > 1:
+            self.tasks.put(None)
+            self.n_workers -= 1
+            self._add_permits(-1)
+
+    def set_queue_size(self, size):
+        'Changes the number of slots in circulation, within the reserved capacity'
+        size = max(1, min(size, self.ring.n_slots))
+        while self.queue_size < size:
+            if self._retire > 0:
+                self._retire -= 1
+            else:
+                self.free_slots.put(self._spare.pop())
+            self.queue_size += 1
+            self._add_permits(1)
+        if self.queue_size > size:
+            self._retire += self.queue_size - size
+            self._add_permits(size - self.queue_size)
+            self.queue_size = size
+
+    def _add_permits(self, n):
+        'Changes the bound on enqueued indices; removed permits are taken back as batches come out'
+        if n < 0:
+            self._pending_debt -= n
+        while n > 0 and self._pending_debt > 0:
+            self._pending_debt -= 1
+            n -= 1
+        for _ in range(n):
+            self._pending.release()
+
+    def slots_memory(self):
+        'Bytes of the slots in circulation'
+        return self.queue_size * self.ring.slot_nbytes
+
+    def memory(self):
+        'Bytes used by the loader: the slots in circulation plus the private memory of the workers'
+        return self.slots_memory() + sum(process_private_memory(w.pid) for w in self.workers if w.is_alive())
+
+    def _feed(self):
+        'Enqueues batch indices epoch after epoch, never more than the workers plus the queue depth ahead of the consumer'
+        epoch = 0
+        while not self._stop_event.is_set():
+            indexes = list(range(len(self.sequence)))
+            if self.shuffle:
+                random.shuffle(indexes)
+            for index in indexes:
+                while not self._pending.acquire(timeout=0.1):
+                    if self._stop_event.is_set():
+                        return
+                self.tasks.put((epoch, index))
+            epoch += 1
+
+    def is_running(self):
+        return self._stop_event is not None and not self._stop_event.is_set()
+
+    def get(self):
+        slot = None
+        while self.is_running():
+            if slot is not None:
+                if self._retire > 0:
+                    self._retire -= 1
+                    self.ring.release(slot)
+                    self._spare.append(slot)
+                else:
+                    self.free_slots.put(slot)
+            while True:
+                try:
+                    slot, index = self.results.get(timeout=1)
+                    break
+                except queue.Empty:
+                    # a killed worker (e.g. by the OOM killer) never reports: fail instead of waiting forever
+                    dead = [w for w in self.workers if not w.is_alive() and w.exitcode != 0]
+                    if dead:
+                        self.stop()
+                        raise RuntimeError('Loader worker exited with code %s' % dead[0].exitcode)
+            if slot is None:
+                self.stop()
+                raise RuntimeError('Loader worker failed:\n%s' % index)
+            if self._pending_debt > 0:
+                self._pending_debt -= 1
+            else:
+                self._pending.release()
+            yield self.ring.read(slot)
+
+    def stop(self, timeout=None):
+        if self._stop_event is None:
+            return
+        self._stop_event.set()
+        for worker in self.workers:
+            worker.terminate()
+        for worker in self.workers:
+            worker.join(timeout)
+        self.workers = []
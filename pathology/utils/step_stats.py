@@ -0,0 +1,97 @@
+import json
+import time
+import numpy as np
+
+
+def batch_nbytes(*arrays):
+    'Bytes of a batch given as arrays, lists or dicts of arrays (None is ignored)'
+    total = 0
+    for a in arrays:
+        if a is None:
+            continue
+        if isinstance(a, dict):
+            a = list(a.values())
+        if isinstance(a, (list, tuple)):
+            total += batch_nbytes(*a)
+        else:
+            total += getattr(a, 'nbytes', 0)
+    return total
+
+
+def queue_depth(enqueuer):
+    'Number of batches ready in an enqueuer, -1 when unknown (no enqueuer, or qsize unsupported)'
+    queue = getattr(enqueuer, 'results', None)
+    if queue is None:
+        queue = getattr(enqueuer, 'queue', None)
+    if queue is None:
+        return -1
+    try:
+        return queue.qsize()
+    except NotImplementedError:
+        return -1
+
+
+class StepStats(object):
+    """
+    Per-step timings of a training loop: time blocked on the data generator, time in train_on_batch,
+    ready batches left in the enqueuer queue and batch bytes.
+    The last step is kept in self.last and the steps of the current epoch summarised by summary();
+    with trace_path every step is also appended as one JSON line.
+    """
+
+    fields = ('data_time', 'compute_time', 'queue_depth', 'batch_bytes', 'batch_size')
+
+    def __init__(self, trace_path=None):
+        self.trace_path = trace_path
+        self._trace = open(trace_path, 'a') if trace_path else None
+        self.last = {}
+        self.reset()
+
+    def reset(self):
+        self._steps = dict((f, []) for f in self.fields)
+        self._epoch_start = self._last_step_end = time.time()
+
+    def record(self, epoch, step, **values):
+        self.last = values
+        self._last_step_end = time.time()
+        for f in self.fields:
+            self._steps[f].append(values[f])
+        if self._trace is not None:
+            line = dict(values, epoch=epoch, step=step, time=time.time())
+            self._trace.write(json.dumps(line) + '\n')
+
+    def window(self, n):
+        'Data-wait times, compute times and queue depths of the last n steps of the epoch'
+        return tuple(np.array(self._steps[f][-n:]) for f in ('data_time', 'compute_time', 'queue_depth'))
+
+    def summary(self):
+        """
+        p50/p95 data-wait and compute times, fraction of the epoch spent waiting on data,
+        mean queue depth and patches per second of wall-clock time (up to the last step, validation excluded)
+        """
+        if not self._steps['data_time']:
+            return {}
+        data = np.array(self._steps['data_time'])
+        compute = np.array(self._steps['compute_time'])
+        elapsed = self._last_step_end - self._epoch_start
+        summary = {
+            'data_time_p50': float(np.percentile(data, 50)),
+            'data_time_p95': float(np.percentile(data, 95)),
+            'compute_time_p50': float(np.percentile(compute, 50)),
+            'compute_time_p95': float(np.percentile(compute, 95)),
+            'data_wait_ratio': float(data.sum() / max(data.sum() + compute.sum(), 1e-12)),
+            'queue_depth_mean': float(np.mean(self._steps['queue_depth'])),
+            'batch_bytes_mean': float(np.mean(self._steps['batch_bytes'])),
+            'patches_per_sec': float(np.sum(self._steps['batch_size']) / max(elapsed, 1e-12)),
+        }
+        return summary
+
+    def write_summary(self, epoch, summary):
+        if self._trace is not None:
+            self._trace.write(json.dumps(dict(summary, epoch=epoch, summary=True)) + '\n')
+            self._trace.flush()
+
+    def close(self):
+        if self._trace is not None:
+            self._trace.close()
+            self._trace = None
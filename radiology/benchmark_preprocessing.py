@@ -0,0 +1,84 @@
+"""Benchmark of the fused float32 preprocessing (preprocess_raw) against resize_raw_to_base + normalize_image.
+
+Usage:
+    benchmark_preprocessing.py [--shapes=<s>] [--repeats=<n>] [--tol=<t>] [--background=<b>]
+    benchmark_preprocessing.py -h | --help
+
+Options:
+    -h --help       Show this screen.
+    --shapes=<s>    Synthetic raw volume shapes (z,y,x), separated by spaces [default: 24,512,512 30,256,256 150,240,240].
+    --repeats=<n>   Timed runs per shape [default: 3].
+    --tol=<t>       Maximum absolute difference with the exact float64 linear resampling and with the current
+                    skimage path [default: 1e-4].
+    --background=<b>  Raw value of the voxels outside the synthetic brain, the volume minimum when negative
+                      [default: -100].
+
+The fused output is checked against an exact reference (scipy map_coordinates, order 1, edges mirrored) and against
+the current path, resize_raw_to_base + normalize_image, with skimage anti-aliasing off: the default before
+skimage 0.15. The difference with the default current path is reported too: larger with newer skimage versions,
+whose resize anti-aliases (smooths) before downsampling by default.
+"""
+import sys
+import time
+
+from docopt import docopt
+import numpy as np
+from scipy import ndimage
+
+from radiology.utils.data_utils import BASE_SHAPE, normalize_image, preprocess_raw, resize_raw_to_base
+
+
+def synthetic_volume(shape, seed=0, background=-100.):
+    'Noisy ellipsoid "brain" on a constant background, with a few NaNs (0 after the scrub)'
+    rs = np.random.RandomState(seed)
+    z, y, x = np.meshgrid(*[np.linspace(-1, 1, n) for n in shape], indexing='ij')
+    brain = z ** 2 / 0.8 + y ** 2 / 0.6 + x ** 2 / 0.7 < 1
+    volume = np.where(brain, rs.rand(*shape) * 500 + 800, background).astype(np.float32)
+    volume[0, 0, :5] = np.nan
+    return volume
+
+
+def exact_reference(data, shape=BASE_SHAPE):
+    'Float64 linear resampling with the pixel-center alignment and edge mirroring of preprocess_raw'
+    data = data.astype(np.float64)
+    data[np.isnan(data)] = 0.
+    data = (data - np.min(data)) / (np.max(data) - np.min(data))
+    data = np.rollaxis(np.rollaxis(data, 1, 0), 2, 1)
+    coords = np.meshgrid(*[(np.arange(n_out) + 0.5) * (n_in / float(n_out)) - 0.5
+                           for n_in, n_out in zip(data.shape, shape)], indexing='ij')
+    return normalize_image(ndimage.map_coordinates(data, coords, order=1, mode='mirror'))
+
+
+def best_time(f, repeats):
+    times = []
+    for _ in range(repeats):
+        start = time.time()
+        result = f()
+        times.append(time.time() - start)
+    return min(times), result
+
+
+if __name__ == '__main__':
+    arguments = docopt(__doc__)
+    shapes = [tuple(int(n) for n in s.split(',')) for s in arguments['--shapes'].split()]
+    repeats = int(arguments['--repeats'])
+    tol = float(arguments['--tol'])
+    background = float(arguments['--background'])
+
+    workspace = {}
+    out = np.empty(BASE_SHAPE, dtype=np.float32)
+    failed = False
+    for shape in shapes:
+        volume = synthetic_volume(shape, background=background)
+        fused_time, fused = best_time(lambda: preprocess_raw(volume, out=out, workspace=workspace), repeats)
+        current_time, current = best_time(lambda: normalize_image(resize_raw_to_base(volume.copy())), repeats)
+        exact_diff = np.abs(fused - exact_reference(volume)).max()
+        aligned_diff = np.abs(fused - normalize_image(resize_raw_to_base(volume.copy(), anti_aliasing=False))).max()
+        current_diff = np.abs(fused - current)
+        over = exact_diff > tol or aligned_diff > tol
+        failed |= over
+        print("%-14s fused %.3fs  current %.3fs  x%.1f  | max diff exact %.1e  current (no anti-aliasing) %.1e%s"
+              "  current max %.1e mean %.1e" % (
+                  "x".join(map(str, shape)), fused_time, current_time, current_time / fused_time, exact_diff,
+                  aligned_diff, " (over tolerance)" if over else "", current_diff.max(), current_diff.mean()))
+    sys.exit(1 if failed else 0)
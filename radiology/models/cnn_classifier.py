@@ -5,7 +5,7 @@ import tensorflow as tf
 
 from radiology.models.model import Model
 from radiology.utils.data_utils import get_ex_paths
-from radiology.utils.dataset import get_dataset_batched
+from radiology.utils.dataset import get_dataset_batched, modality_flags
 from radiology.utils.general import Progbar
 from radiology.utils.lr_schedule import LRSchedule
 from radiology.utils.metrics import all_scores
@@ -15,7 +15,8 @@ class CNN_Classifier(Model):
     def __init__(self, config):
         self.config = config
         self.nb_classes = config.nb_classes
-        self.nb_modalities = config.use_t1post + config.use_flair + config.use_t1pre + config.use_t2
+        # channels in the order of MODALITY_TYPES in radiology/utils/dataset.py
+        self.nb_modalities = sum(modality_flags(config))
 
         self.load_data()
         self.add_dataset()
@@ -31,7 +32,9 @@ class CNN_Classifier(Model):
         self.val_ex_paths = get_ex_paths(self.config.val_path)
 
     def add_dataset(self):
-        train_dataset = get_dataset_batched(self.config.train_path, False, self.config)
+        # fed when initializing the training iterator: the shuffle and flips of an epoch only depend on it
+        self.epoch_placeholder = tf.placeholder_with_default(tf.constant(0, dtype=tf.int64), shape=[])
+        train_dataset = get_dataset_batched(self.config.train_path, False, self.config, epoch=self.epoch_placeholder)
 
         train_nodrop_dataset = get_dataset_batched(self.config.train_path, True, self.config)
         val_dataset = get_dataset_batched(self.config.val_path, True, self.config)
@@ -42,7 +45,7 @@ class CNN_Classifier(Model):
             output_types=(tf.float32,
                           tf.float32,
                           tf.int32),
-            output_shapes=([None, 320, 320, 24, self.nb_modalities],
+            output_shapes=([None] + list(self.config.input_shape) + [self.nb_modalities],
                            [None, 1],
                            [None, 1]))
         self.image, self.mgmtmethylated, self.patientid = self.iterator.get_next()
@@ -68,7 +71,7 @@ class CNN_Classifier(Model):
         self.merged = tf.summary.merge_all()
         self.file_writer = tf.summary.FileWriter(summary_path, sess.graph)
 
-    def run_epoch(self, sess, lr_schedule):
+    def run_epoch(self, sess, lr_schedule, epoch=0):
         losses = []
         bdices = []
         batch = 0
@@ -76,7 +79,7 @@ class CNN_Classifier(Model):
         nbatches = len(self.train_ex_paths)
         prog = Progbar(target=nbatches)
 
-        sess.run(self.train_init_op)
+        sess.run(self.train_init_op, feed_dict={self.epoch_placeholder: epoch})
 
         while True:
             try:
@@ -220,7 +223,7 @@ class CNN_Classifier(Model):
         print('Start training ....')
         for epoch in range(1, config.num_epochs + 1):
             print('\nEpoch %d ...' % epoch)
-            losses, train_dice = self.run_epoch(sess, lr_schedule)
+            losses, train_dice = self.run_epoch(sess, lr_schedule, epoch)
             train_losses.extend(losses)
 
             if epoch % 2 == 0:
@@ -39,3 +39,18 @@ class Config:
         self.num_train_batches = int(param_dict.get('num_train_batches', 20))
         self.num_val_batches = int(param_dict.get('num_val_batches', 20))
         self.num_epochs = int(param_dict.get('num_epochs', 50))
+
+        # preprocessed volumes cache (float32 or float16 .npy files), none if no cache_dir
+        self.cache_dir = param_dict.get('cache_dir')
+        self.cache_dtype = param_dict.get('cache_dtype', 'float32')
+        # float32 fused resampling and normalization (preprocess_raw) instead of skimage resize + normalize_image
+        self.fused_preprocessing = param_dict.get('fused_preprocessing', 'True') == 'True'
+
+        # input pipeline: volumes loaded in parallel, batches prefetched, per-epoch order and flips drawn from seed
+        self.num_parallel_calls = int(param_dict.get('num_parallel_calls', 4))
+        self.prefetch = int(param_dict.get('prefetch', 2))
+        self.seed = int(param_dict.get('seed', 0))
+
+        # (y, x, z) volume shape seen by the model; other than 320,320,24, volumes are cropped to the brain bounding box,
+        # then padded or resampled to it (multiples of 16 go through the four poolings without remainder)
+        self.input_shape = tuple(int(n) for n in param_dict.get('input_shape', '320,320,24').split(','))
@@ -30,11 +30,163 @@ def normalize_image(image):
     return image
 
 
-def resize_raw_to_base(data):
+def resize_raw_to_base(data, anti_aliasing=None):
+    'anti_aliasing is passed on to skimage resize unless None (its default: smoothing before downsampling since 0.15)'
     data[np.isnan(data)] = 0.
     M = np.max(data)
     m = np.min(data)
     data = (data - m) / (M - m)
     data = np.rollaxis(data, 1, 0)
     data = np.rollaxis(data, 2, 1)
-    return resize(data, (320, 320, 24))
+    if anti_aliasing is None:
+        return resize(data, (320, 320, 24))
+    return resize(data, (320, 320, 24), anti_aliasing=anti_aliasing)
+
+
+BASE_SHAPE = (320, 320, 24)
+
+
+def linear_weights(n_in, n_out):
+    """
+    Source indexes and weights of a 1D linear resampling from n_in to n_out samples, pixel centers aligned
+    and mirrored at the edges without repeating the edge sample (as skimage resize with mode 'reflect')
+    """
+    x = np.abs((np.arange(n_out) + 0.5) * (n_in / float(n_out)) - 0.5)
+    x = np.clip(np.where(x > n_in - 1, 2 * (n_in - 1) - x, x), 0, n_in - 1)
+    i0 = np.minimum(np.floor(x).astype(np.intp), max(n_in - 2, 0))
+    i1 = np.minimum(i0 + 1, n_in - 1)
+    return i0, i1, (x - i0).astype(np.float32)
+
+
+def _buffer(workspace, name, shape, dtype=np.float32):
+    buf = workspace.get(name)
+    if buf is None or buf.shape != shape:
+        buf = workspace[name] = np.empty(shape, dtype=dtype)
+    return buf
+
+
+def _resample_axis(src, axis, n_out, workspace, name):
+    i0, i1, w = linear_weights(src.shape[axis], n_out)
+    shape = src.shape[:axis] + (n_out,) + src.shape[axis + 1:]
+    a, b = _buffer(workspace, name + 'a', shape), _buffer(workspace, name + 'b', shape)
+    np.take(src, i0, axis=axis, out=a)
+    np.take(src, i1, axis=axis, out=b)
+    w = w.reshape((-1,) + (1,) * (src.ndim - axis - 1))
+    a *= 1 - w
+    b *= w
+    a += b
+    return a
+
+
+def preprocess_raw(data, shape=BASE_SHAPE, out=None, workspace=None, background=None):
+    """
+    Fused float32 equivalent of normalize_image(resize_raw_to_base(data)) for a (z, y, x) volume:
+    NaN scrub, separable linear resampling to shape (y, x, z), brain-mask z-scoring.
+    The min-max scaling cancels out in the z-score, so only the minimum is subtracted, before resampling
+    as in resize_raw_to_base: the background interpolates to exactly 0 whatever its raw value, and stays out of
+    the brain mask. Mask statistics come from one pass of sums.
+    Resampling matches skimage resize with order 1 and no anti-aliasing (the default before skimage 0.15).
+    Pass the same workspace dict across calls to reuse the intermediate buffers.
+    background: value subtracted instead of the minimum of data, e.g. the minimum of the volume data was cropped from.
+    """
+    if workspace is None:
+        workspace = {}
+    if out is None:
+        out = np.empty(shape, dtype=np.float32)
+
+    raw = _buffer(workspace, 'raw', data.shape)
+    np.copyto(raw, data, casting='unsafe')
+    np.nan_to_num(raw, copy=False)
+    raw -= raw.min() if background is None else background
+
+    # (z, y, x) -> target sizes (z, y, x), most shrunk axis first so later passes run on less data
+    target = (shape[2], shape[0], shape[1])
+    volume = raw
+    for axis in sorted(range(3), key=lambda k: target[k] / float(raw.shape[k])):
+        if volume.shape[axis] != target[axis]:
+            volume = _resample_axis(volume, axis, target[axis], workspace, 'axis%d' % axis)
+    np.copyto(out, volume.transpose(1, 2, 0))
+
+    count = np.count_nonzero(out)
+    if count == 0:
+        return out
+    mu = out.sum(dtype=np.float64) / count
+    sigma = np.sqrt(max(np.einsum('i,i->', out.ravel(), out.ravel(), dtype=np.float64) / count - mu * mu, 0.))
+    brain = np.not_equal(out, 0, out=_buffer(workspace, 'brain', out.shape, bool))
+    np.subtract(out, mu, out=out, where=brain)
+    np.multiply(out, 1. / sigma if sigma > 0 else 0., out=out, where=brain)
+    return out
+
+
+def brain_bounding_box(volume):
+    'Slices of the tight bounding box of the non-zero voxels of a (y, x, z, channels) volume (any channel)'
+    brain = np.any(volume != 0, axis=-1)
+    box = []
+    for axis in range(3):
+        nonzero = np.flatnonzero(np.any(brain, axis=tuple(k for k in range(3) if k != axis)))
+        if len(nonzero) == 0:
+            return tuple(slice(0, n) for n in volume.shape[:3])
+        box.append(slice(nonzero[0], nonzero[-1] + 1))
+    return tuple(box)
+
+
+def crop_to_brain(volume, shape, workspace=None):
+    """
+    Crops a (y, x, z, channels) volume to its brain bounding box and brings it to shape (y, x, z):
+    axes of the box larger than shape are linearly resampled down to it, smaller ones centered and zero-padded
+    """
+    if workspace is None:
+        workspace = {}
+    cropped = volume[brain_bounding_box(volume)]
+    for axis in range(3):
+        if cropped.shape[axis] > shape[axis]:
+            cropped = _resample_axis(cropped, axis, shape[axis], workspace, 'crop%d' % axis)
+    out = np.zeros(tuple(shape) + volume.shape[3:], dtype=np.float32)
+    offsets = [(n - m) // 2 for n, m in zip(shape, cropped.shape)]
+    out[tuple(slice(o, o + m) for o, m in zip(offsets, cropped.shape[:3]))] = cropped
+    return out
+
+
+def source_brain_box(data):
+    """
+    Tight bounding box of the brain of a raw (z, y, x) volume as (start, stop) fractions of each axis:
+    the voxels above the volume minimum (NaNs counting as 0), which preprocess_raw keeps non-zero.
+    The whole volume when there is no such voxel.
+    """
+    data = np.nan_to_num(data)
+    brain = data > data.min()
+    box = []
+    for axis in range(3):
+        nonzero = np.flatnonzero(np.any(brain, axis=tuple(k for k in range(3) if k != axis)))
+        if len(nonzero) == 0:
+            return np.array([[0., 1.]] * 3)
+        box.append((nonzero[0] / float(data.shape[axis]), (nonzero[-1] + 1) / float(data.shape[axis])))
+    return np.array(box)
+
+
+def preprocess_raw_cropped(volumes, shape, workspace=None):
+    """
+    Cropped equivalent of crop_to_brain(stack of preprocess_raw(volume)) for raw (z, y, x) volumes of one patient,
+    with a single resampling: each volume is cropped in its own source space to the union of their brain boxes
+    (as fractions, so the modalities may differ in size), then resampled straight to the size the box has at
+    BASE_SHAPE, or to shape (y, x, z) on the axes where that is larger, and centered and zero-padded in shape.
+    Returns a (y, x, z, len(volumes)) float32 stack.
+    """
+    if workspace is None:
+        workspace = {}
+    boxes = np.array([source_brain_box(data) for data in volumes])
+    box = np.stack([boxes[:, :, 0].min(axis=0), boxes[:, :, 1].max(axis=0)], axis=1)
+    # source axes (z, y, x) are the axes (2, 0, 1) of BASE_SHAPE and shape
+    target = tuple(max(1, min(shape[k], int(round((box[axis, 1] - box[axis, 0]) * BASE_SHAPE[k]))))
+                   for axis, k in enumerate((2, 0, 1)))
+    target = (target[1], target[2], target[0])
+    out = np.zeros(tuple(shape) + (len(volumes),), dtype=np.float32)
+    offsets = [(n - m) // 2 for n, m in zip(shape, target)]
+    region = tuple(slice(o, o + m) for o, m in zip(offsets, target))
+    for channel, data in enumerate(volumes):
+        crop = tuple(slice(int(np.floor(start * n)), int(np.ceil(stop * n)))
+                     for (start, stop), n in zip(box, data.shape))
+        # the minimum of the whole volume, as preprocess_raw subtracts from an uncropped one
+        background = np.nan_to_num(data).min()
+        out[region + (channel,)] = preprocess_raw(data[crop], shape=target, workspace=workspace, background=background)
+    return out
@@ -3,15 +3,26 @@ import os
 import numpy as np
 import tensorflow as tf
 
-from radiology.utils.data_utils import im_path_to_arr, resize_raw_to_base
-from radiology.utils.data_utils import normalize_image
+from radiology.utils.data_utils import BASE_SHAPE
+from radiology.utils.volume_cache import load_brain_stack, load_volume
 
 KEPT_PATIENTS = set(["cbtc_train_" + str(i) for i in range(33) if i not in [1, 8, 9, 18, 26]])
 KEPT_PATIENTS_TEST = set(["cbtc_test_" + str(i) for i in range(33) if i not in [31]])
+# file prefix of each modality, in the order of the channels (see modality_flags)
+MODALITY_TYPES = ('t1c', 'flair', 't1', 't2')
 
 
-def load_data_miccai(patient_path, is_test, modalities):
-    data = [None] * len(modalities)
+def modality_flags(config):
+    return (config.use_t1post, config.use_flair, config.use_t1pre, config.use_t2)
+
+
+def load_data_miccai(patient_path, modalities, cache_dir=None, cache_dtype='float32', fused=True,
+                     input_shape=BASE_SHAPE):
+    """
+    Volumes of the modalities flagged in modalities (same order as MODALITY_TYPES), stacked on the last axis.
+    Only the files of those modalities are read. With an input_shape other than BASE_SHAPE, the stack is
+    cropped to the brain bounding box and brought to input_shape, and cached as such (load_brain_stack).
+    """
     patient_path = patient_path.decode('utf-8')
 
     im_type_to_path = {}
@@ -22,42 +33,37 @@ def load_data_miccai(patient_path, is_test, modalities):
         im_type = im_name.split('_')[0].lower()
         im_type_to_path[im_type] = im_path
 
-    for im_type in im_type_to_path:
-        image = im_path_to_arr(im_type_to_path[im_type])
-        image = resize_raw_to_base(image)
-        if im_type == 't1c' and modalities[0]:
-            image = normalize_image(image)
-            data[0] = image
-        elif im_type == 'flair' and modalities[1]:
-            image = normalize_image(image)
-            data[1] = image
-
-    # remove index where modality is not used
-    data = [item for item in data if item is not None]
-    # data = [resize_data_to_brats_size(item) for item in data]
-    data = np.concatenate([item[..., np.newaxis] for item in data], axis=3)
-
-    # random flip around sagittal axis
-    if not is_test:
-        flip = np.random.random()
-        if flip < 0.5:
-            data = data[:, :, ::-1, :]
+    im_types = [im_type for im_type, used in zip(MODALITY_TYPES, modalities) if used]
+    missing = [im_type for im_type in im_types if im_type not in im_type_to_path]
+    if missing:
+        raise ValueError("%s has no %s volume" % (patient_path, ", ".join(missing)))
 
-    return data
+    if tuple(input_shape) != BASE_SHAPE:
+        stack = load_brain_stack([im_type_to_path[im_type] for im_type in im_types], input_shape, cache_dir,
+                                 cache_dtype, fused)
+        return np.asarray(stack, dtype=np.float32)
 
+    data = None
+    for channel, im_type in enumerate(im_types):
+        # preprocessed (resized and normalized) volume, from the cache after the first epoch
+        image = load_volume(im_type_to_path[im_type], cache_dir, cache_dtype, fused)
+        if data is None:
+            data = np.empty(image.shape + (len(im_types),), dtype=np.float32)
+        data[..., channel] = image
+
+    return data
 
-def gen_tcga_miccai(directory, is_test, config):
-    modalities = (config.use_t1post, config.use_flair, config.use_segmentation)
 
+def list_patients(directory):
+    """
+    Sorted patient paths (bytes, as tf.py_func passes them) of a directory, with their stage (-1 if unknown) and id
+    """
     patients = os.listdir(directory)
     patients = list(set(patients).intersection(KEPT_PATIENTS.union(KEPT_PATIENTS_TEST)))
     patients = [os.path.join(directory, pat) for pat in patients]
     patients = [pat.encode('utf-8') for pat in patients]  # need to encode in bytes to pass it to tf.py_func
 
     patients.sort()
-    if not is_test:
-        np.random.seed(0)
-        np.random.shuffle(patients)
 
     patients_stage_path = os.path.join(directory,
                                        "../datasets_None_4b87ae5a-4ca7-4b95-99f5-09ce31da60e0_README_all_training.txt")
@@ -65,25 +71,53 @@ def gen_tcga_miccai(directory, is_test, config):
         lines = f.readlines()
     labels = {int(q.split(" ")[0].split("_")[-1]): {'A': 1, 'O': 0}[q.strip("\n")[-1]] for q in lines[10:]}
 
-    for patient in patients:
-        image = load_data_miccai(patient, is_test, modalities)
-        patient_id = int(patient.decode("utf-8").split("/")[-1].split("_")[-1])
-        if patient_id in labels:
-            stage = labels[patient_id]
-        else:
-            stage = -1
-        print(patient_id)
-        yield image, stage, patient_id
-
-
-def get_dataset_batched(directory, is_test, config):
-    def gen():
-        return gen_tcga_miccai(directory, is_test, config)
-
-    dataset = tf.data.Dataset.from_generator(generator=gen,
-                                             output_types=(tf.float32, tf.float32, tf.int32))
-    batch_size = config.batch_size
-    batched_dataset = dataset.batch(batch_size)
-    batched_dataset = batched_dataset.prefetch(1)
+    patient_ids = [int(patient.decode("utf-8").split("/")[-1].split("_")[-1]) for patient in patients]
+    stages = [labels.get(patient_id, -1) for patient_id in patient_ids]
+    return patients, stages, patient_ids
+
+
+def epoch_order(n, seed, epoch, is_test):
+    """
+    Patient order and sagittal flips of an epoch, only depending on (seed, epoch);
+    test sets keep the sorted order and are never flipped
+    """
+    if is_test:
+        return np.arange(n, dtype=np.int64), np.zeros(n, dtype=bool)
+    rs = np.random.RandomState([seed, epoch])
+    return rs.permutation(n).astype(np.int64), rs.random_sample(n) < 0.5
+
+
+def get_dataset_batched(directory, is_test, config, epoch=None):
+    """
+    Batches of (volumes, stages, patient ids) of the patients of directory. Volumes are loaded by
+    config.num_parallel_calls parallel map calls and config.prefetch batches ahead.
+    epoch: int64 scalar tensor (fed when initializing the iterator) choosing the shuffle and flips of the epoch
+    """
+    modalities = modality_flags(config)
+    patients, stages, patient_ids = list_patients(directory)
+    if epoch is None:
+        epoch = tf.constant(0, dtype=tf.int64)
+
+    order, flips = tf.py_func(lambda e: epoch_order(len(patients), config.seed, e, is_test), [epoch],
+                              [tf.int64, tf.bool], stateful=False)
+    order.set_shape([len(patients)])
+    flips.set_shape([len(patients)])
+    dataset = tf.data.Dataset.from_tensor_slices((tf.gather(tf.constant(patients), order),
+                                                  tf.gather(tf.constant(stages, dtype=tf.float32), order),
+                                                  tf.gather(tf.constant(patient_ids, dtype=tf.int32), order),
+                                                  flips))
+
+    def load(patient, stage, patient_id, flip):
+        # the sagittal flip of the epoch is applied in the graph below
+        image = tf.py_func(lambda path: load_data_miccai(path, modalities, config.cache_dir, config.cache_dtype,
+                                                         config.fused_preprocessing, config.input_shape),
+                           [patient], tf.float32, stateful=False)
+        image.set_shape(tuple(config.input_shape) + (sum(modalities),))
+        image = tf.cond(flip, lambda: tf.reverse(image, axis=[2]), lambda: image)
+        return image, tf.reshape(stage, [1]), tf.reshape(patient_id, [1])
+
+    dataset = dataset.map(load, num_parallel_calls=config.num_parallel_calls)
+    batched_dataset = dataset.batch(config.batch_size)
+    batched_dataset = batched_dataset.prefetch(config.prefetch)
 
     return batched_dataset
@@ -0,0 +1,120 @@
+import hashlib
+import os
+import tempfile
+import threading
+
+import numpy as np
+
+from radiology.utils.data_utils import BASE_SHAPE, im_path_to_arr, resize_raw_to_base
+from radiology.utils.data_utils import crop_to_brain, normalize_image, preprocess_raw, preprocess_raw_cropped
+
+# bump when the preprocessing below changes, so that stale cache entries are not reused
+PREPROCESSING_VERSION = 2
+HASH_BYTES = 1 << 20
+# preprocess_raw intermediate buffers, one set per loading thread
+_local = threading.local()
+# content hashes of the source volumes, by (path, size, mtime): computed once per process
+_hashes = {}
+
+
+def preprocess_volume(im_path, fused=True):
+    image = im_path_to_arr(im_path)
+    if fused:
+        if not hasattr(_local, 'workspace'):
+            _local.workspace = {}
+        return preprocess_raw(image, workspace=_local.workspace)
+    image = resize_raw_to_base(image)
+    return normalize_image(image)
+
+
+def volume_key(im_path, dtype, fused=True):
+    """
+    Cache key of the preprocessed volume of im_path: source size, mtime and a hash of its first and last MiB,
+    plus the preprocessing version and parameters (implementation, target BASE_SHAPE) and the stored dtype.
+    The source is only read the first time a (path, size, mtime) is seen in the process, later calls just stat it.
+    """
+    stat = os.stat(im_path)
+    source = (im_path, stat.st_size, stat.st_mtime_ns)
+    content = _hashes.get(source)
+    if content is None:
+        h = hashlib.sha1()
+        with open(im_path, 'rb') as f:
+            h.update(f.read(HASH_BYTES))
+            if stat.st_size > HASH_BYTES:
+                f.seek(max(HASH_BYTES, stat.st_size - HASH_BYTES))
+                h.update(f.read(HASH_BYTES))
+        content = _hashes[source] = h.hexdigest()
+    h = hashlib.sha1()
+    h.update(("%d %d %d %s %s %s %s" % (stat.st_size, stat.st_mtime_ns, PREPROCESSING_VERSION,
+                                        'fused' if fused else 'skimage', 'x'.join(str(n) for n in BASE_SHAPE),
+                                        np.dtype(dtype).name, content)).encode('utf-8'))
+    return h.hexdigest()
+
+
+def load_volume(im_path, cache_dir=None, dtype='float32', fused=True):
+    """
+    Preprocessed volume of im_path, by preprocess_raw or else the skimage path. With a cache_dir, it is
+    computed once and stored as <cache_dir>/<key[:2]>/<key>.npy, then memory-mapped (read-only) on later calls.
+    """
+    if cache_dir is None:
+        return preprocess_volume(im_path, fused)
+
+    key = volume_key(im_path, dtype, fused)
+    path = os.path.join(cache_dir, key[:2], key + ".npy")
+    if os.path.exists(path):
+        return np.load(path, mmap_mode='r')
+
+    image = preprocess_volume(im_path, fused).astype(dtype)
+    save_entry(path, image)
+    return image
+
+
+def brain_stack_key(im_paths, dtype, fused, input_shape):
+    'Cache key of the brain-cropped stack of im_paths at input_shape: the volume keys of its channels and the shape'
+    h = hashlib.sha1()
+    h.update(("brain %s %s" % ('x'.join(str(n) for n in input_shape),
+                               ' '.join(volume_key(im_path, dtype, fused) for im_path in im_paths))).encode('utf-8'))
+    return h.hexdigest()
+
+
+def load_brain_stack(im_paths, input_shape, cache_dir=None, dtype='float32', fused=True):
+    """
+    (y, x, z, channels) stack of the volumes of im_paths cropped to their brain bounding box at input_shape.
+    preprocess_raw_cropped crops the fused path in source space, with a single resampling; the skimage path
+    is cropped after its resampling to BASE_SHAPE (crop_to_brain). With a cache_dir, the stack is stored once
+    as <cache_dir>/<key[:2]>/<key>.npy and memory-mapped (read-only) on later calls.
+    """
+    if cache_dir is not None:
+        key = brain_stack_key(im_paths, dtype, fused, input_shape)
+        path = os.path.join(cache_dir, key[:2], key + ".npy")
+        if os.path.exists(path):
+            return np.load(path, mmap_mode='r')
+
+    if fused:
+        if not hasattr(_local, 'workspace'):
+            _local.workspace = {}
+        stack = preprocess_raw_cropped([im_path_to_arr(im_path) for im_path in im_paths], input_shape,
+                                       workspace=_local.workspace)
+    else:
+        stack = np.stack([preprocess_volume(im_path, fused) for im_path in im_paths], axis=-1).astype(np.float32)
+        stack = crop_to_brain(stack, input_shape)
+    stack = stack.astype(dtype)
+    if cache_dir is not None:
+        save_entry(path, stack)
+    return stack
+
+
+def save_entry(path, array):
+    'Writes a cache entry under a unique temporary name, so concurrent readers and writers never see a partial one'
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory, exist_ok=True)
+    # unique per thread too: the tf.data map calls load volumes on several threads of one process
+    fd, tmp_path = tempfile.mkstemp(suffix='.tmp.npy', dir=directory)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.save(f, array)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise